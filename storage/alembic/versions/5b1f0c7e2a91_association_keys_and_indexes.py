@@ -0,0 +1,60 @@
+"""association keys and indexes
+
+Revision ID: 5b1f0c7e2a91
+Revises: 
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1f0c7e2a91'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+# the association tables with the column pointing to the owner and the
+# column pointing to the associated object
+ASSOCIATIONS = [
+    ('job_remote', 'job_id', 'remote_id'),
+    ('job_experience', 'job_id', 'experience_id'),
+    ('job_job_type', 'job_id', 'job_type_id'),
+    ('job_role', 'job_id', 'role_id'),
+    ('job_technology', 'job_id', 'technology_id'),
+    ('job_skill', 'job_id', 'skill_id'),
+    ('job_joel_test', 'job_id', 'joel_test_id'),
+    ('company_industry', 'company_id', 'industry_id'),
+    ('company_benefit', 'company_id', 'benefit_id'),
+]
+
+# the indexed columns of the job table
+JOB_INDEXES = ['created', 'updated']
+
+
+def upgrade():
+    # tables that do not exist yet are created by create_all with their keys
+    inspector = sa.inspect(op.get_bind())
+    tables = set(inspector.get_table_names())
+    for table, owner, other in ASSOCIATIONS:
+        if table not in tables:
+            continue
+        if not inspector.get_pk_constraint(table)['constrained_columns']:
+            # drop the incomplete and the duplicate rows before adding the key
+            op.execute('DELETE FROM {0} WHERE {1} IS NULL OR {2} IS NULL'.format(table, owner, other))
+            op.execute('DELETE FROM {0} a USING {0} b '
+                       'WHERE a.ctid < b.ctid AND a.{1} = b.{1} AND a.{2} = b.{2}'.format(table, owner, other))
+            op.create_primary_key('{}_pkey'.format(table), table, [owner, other])
+        op.execute('CREATE INDEX IF NOT EXISTS ix_{0}_{1} ON {0} ({1})'.format(table, other))
+    if 'job' in tables:
+        for column in JOB_INDEXES:
+            op.execute('CREATE INDEX IF NOT EXISTS ix_job_{0} ON job ({0})'.format(column))
+
+
+def downgrade():
+    for column in JOB_INDEXES:
+        op.execute('DROP INDEX IF EXISTS ix_job_{}'.format(column))
+    for table, _, other in ASSOCIATIONS:
+        op.execute('DROP INDEX IF EXISTS ix_{}_{}'.format(table, other))
+        op.execute('ALTER TABLE IF EXISTS {0} DROP CONSTRAINT IF EXISTS {0}_pkey'.format(table))
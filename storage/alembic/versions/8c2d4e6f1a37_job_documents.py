@@ -0,0 +1,28 @@
+"""job documents
+
+Revision ID: 8c2d4e6f1a37
+Revises: 5b1f0c7e2a91
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c2d4e6f1a37'
+down_revision = '5b1f0c7e2a91'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the documents are filled by python manage.py rebuild-documents, and
+    # meanwhile built on read
+    op.execute('ALTER TABLE IF EXISTS job ADD COLUMN IF NOT EXISTS document JSONB')
+    op.execute('ALTER TABLE IF EXISTS job ADD COLUMN IF NOT EXISTS document_updated TIMESTAMP WITHOUT TIME ZONE')
+
+
+def downgrade():
+    op.execute('ALTER TABLE IF EXISTS job DROP COLUMN IF EXISTS document_updated')
+    op.execute('ALTER TABLE IF EXISTS job DROP COLUMN IF EXISTS document')
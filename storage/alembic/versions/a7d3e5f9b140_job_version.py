@@ -0,0 +1,27 @@
+"""job version
+
+Revision ID: a7d3e5f9b140
+Revises: f3b9c2d7e815
+Create Date: 2026-10-18 21:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7d3e5f9b140'
+down_revision = 'f3b9c2d7e815'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # created before any process writes jobs, including python manage.py,
+    # in place of the sequence of earlier builds, which shares its name
+    op.execute('DROP SEQUENCE IF EXISTS job_version')
+    op.execute('CREATE TABLE IF NOT EXISTS job_version (id INTEGER PRIMARY KEY, version BIGINT NOT NULL)')
+
+
+def downgrade():
+    op.execute('DROP TABLE IF EXISTS job_version')
@@ -0,0 +1,35 @@
+"""job search vector
+
+Revision ID: d4a7b9e1c052
+Revises: 8c2d4e6f1a37
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a7b9e1c052'
+down_revision = '8c2d4e6f1a37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # a job table that does not exist yet is created by create_all with its index
+    if 'job' not in sa.inspect(op.get_bind()).get_table_names():
+        return
+    # computing the column rewrites the table, and the index then reads it once
+    op.execute("""
+        ALTER TABLE job ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('english', regexp_replace(coalesce(description, ''), '<[^>]*>', ' ', 'g')), 'B')
+        ) STORED""")
+    op.execute('CREATE INDEX IF NOT EXISTS ix_job_search_vector ON job USING gin (search_vector)')
+
+
+def downgrade():
+    op.execute('DROP INDEX IF EXISTS ix_job_search_vector')
+    op.execute('ALTER TABLE IF EXISTS job DROP COLUMN IF EXISTS search_vector')
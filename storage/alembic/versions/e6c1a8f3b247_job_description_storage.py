@@ -0,0 +1,43 @@
+"""job description storage
+
+Revision ID: e6c1a8f3b247
+Revises: d4a7b9e1c052
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6c1a8f3b247'
+down_revision = 'd4a7b9e1c052'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # a job table that does not exist yet is created by create_all with its storage settings
+    bind = op.get_bind()
+    if 'job' not in sa.inspect(bind).get_table_names():
+        return
+    # the settings apply to the rows written from now on, and the documents
+    # drop their descriptions with python manage.py rebuild-documents --all
+    op.execute('ALTER TABLE job SET (toast_tuple_target = 256)')
+    if bind.dialect.server_version_info < (14,):
+        return
+    try:
+        with bind.begin_nested():
+            bind.execute(sa.text(
+                'ALTER TABLE job ALTER COLUMN description SET COMPRESSION lz4, '
+                'ALTER COLUMN document SET COMPRESSION lz4'))
+    except sa.exc.NotSupportedError:
+        pass
+
+
+def downgrade():
+    op.execute('ALTER TABLE IF EXISTS job RESET (toast_tuple_target)')
+    bind = op.get_bind()
+    if bind.dialect.server_version_info >= (14,) and 'job' in sa.inspect(bind).get_table_names():
+        op.execute('ALTER TABLE job ALTER COLUMN description SET COMPRESSION default, '
+                   'ALTER COLUMN document SET COMPRESSION default')
@@ -0,0 +1,57 @@
+"""cooccurrence counts
+
+Revision ID: f3b9c2d7e815
+Revises: e6c1a8f3b247
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b9c2d7e815'
+down_revision = 'e6c1a8f3b247'
+branch_labels = None
+depends_on = None
+
+# the co-occurrence tables with the association table and the column
+# pointing to the listed value
+COOCCURRENCES = [
+    ('technology_cooccurrence', 'technology', 'job_technology', 'technology_id'),
+    ('role_cooccurrence', 'role', 'job_role', 'role_id'),
+    ('skill_cooccurrence', 'skill', 'job_skill', 'skill_id'),
+]
+
+
+def upgrade():
+    # a job table that does not exist yet is created by create_all with empty
+    # co-occurrence tables, which the writes of the jobs keep up to date
+    bind = op.get_bind()
+    if 'job' not in sa.inspect(bind).get_table_names():
+        return
+    # the tables are filled here, before the workers start and write jobs
+    for table, model, association, column in COOCCURRENCES:
+        op.execute("""
+            CREATE TABLE IF NOT EXISTS {0} (
+                day DATE NOT NULL,
+                first_id INTEGER NOT NULL REFERENCES {1} (id),
+                second_id INTEGER NOT NULL REFERENCES {1} (id),
+                count INTEGER NOT NULL,
+                PRIMARY KEY (day, first_id, second_id))""".format(table, model))
+        if bind.execute(sa.text('SELECT 1 FROM {} LIMIT 1'.format(table))).first() is not None:
+            continue
+        op.execute("""
+            INSERT INTO {0} (day, first_id, second_id, count)
+            SELECT CAST(job.created AS DATE), a.{2}, b.{2}, count(*)
+            FROM job
+            JOIN {1} a ON a.job_id = job.id
+            JOIN {1} b ON b.job_id = job.id AND a.{2} < b.{2}
+            WHERE job.created IS NOT NULL
+            GROUP BY 1, 2, 3
+            ON CONFLICT DO NOTHING""".format(table, association, column))
+
+
+def downgrade():
+    for table, _, _, _ in COOCCURRENCES:
+        op.execute('DROP TABLE IF EXISTS {}'.format(table))
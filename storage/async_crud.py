@@ -0,0 +1,199 @@
+from itertools import islice
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from typing import List, Optional, Dict, Any, Tuple, Iterator, AsyncIterator, Callable, Union
+from datetime import date, datetime
+
+import crud, schemas
+
+# the number of items of a synchronous generator produced per step
+STREAM_STEP_SIZE = 100
+
+AnySession = Union[Session, AsyncSession]
+
+async def run(db: AnySession, function: Callable, *args, **kwargs) -> Any:
+    '''
+    Call a crud function with the synchronous session of db without blocking
+    the event loop: in the greenlet of an asyncio session, or in the
+    threadpool for a blocking session
+    '''
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(function, *args, **kwargs)
+    return await run_in_threadpool(function, db, *args, **kwargs)
+
+def sync_session(db: AnySession) -> Session:
+    '''
+    Get the synchronous session of db
+    '''
+    return db.sync_session if isinstance(db, AsyncSession) else db
+
+async def iterate(db: AnySession, iterator: Iterator[Any]) -> AsyncIterator[Any]:
+    '''
+    Iterate over a synchronous generator that reads from the session of db,
+    advancing it a few items at a time with run
+    '''
+    while True:
+        items = await run(db, lambda _: list(islice(iterator, STREAM_STEP_SIZE)))
+        if not items:
+            break
+        for item in items:
+            yield item
+
+# The functions below return documents instead of database objects, since the
+# objects of an asyncio session cannot load their relationships outside of it.
+
+async def get_job(db: AnySession, job_id: int) -> Optional[schemas.Job]:
+    '''
+    Retrieve the Job document with the given id
+    '''
+    def read(session: Session) -> Optional[schemas.Job]:
+        job = crud.get_job(session, job_id=job_id)
+        return schemas.Job.from_orm(job) if job is not None else None
+    return await run(db, read)
+
+async def get_job_document_texts(db: AnySession, offset: int=0, limit: Optional[int]=None,
+                                after_id: Optional[int]=None, updated_since: Optional[datetime]=None,
+                                created_since: Optional[datetime]=None,
+                                fields: Optional[List[str]]=None,
+                                job_ids: Optional[List[int]]=None) -> Tuple[List[str], Optional[int]]:
+    '''
+    Retrieve the stored JSON documents of crud.get_job_document_texts, along
+    with the id of the last job
+    '''
+    return await run(db, crud.get_job_document_texts, offset=offset, limit=limit, after_id=after_id,
+                     updated_since=updated_since, created_since=created_since, fields=fields,
+                     job_ids=job_ids)
+
+async def get_job_document_text(db: AnySession, job_id: int) -> Optional[str]:
+    '''
+    Retrieve the stored JSON document of the job with the given id
+    '''
+    texts, _ = await run(db, crud.get_job_document_texts, job_ids=[job_id])
+    return texts[0] if texts else None
+
+async def search_jobs(db: AnySession, q: str, limit: int=crud.SEARCH_PAGE_SIZE,
+                      after: Optional[Tuple[float, int]]=None, recent: Optional[int]=None) -> List[Dict[str, Any]]:
+    '''
+    Search the jobs, as crud.search_jobs
+    '''
+    return await run(db, crud.search_jobs, q=q, limit=limit, after=after, recent=recent)
+
+async def stream_jobs(db: AnySession, serialize: Callable, offset: int=0, limit: Optional[int]=None,
+                      after_id: Optional[int]=None, updated_since: Optional[datetime]=None,
+                      created_since: Optional[datetime]=None, fields: Optional[List[str]]=None,
+                      job_ids: Optional[List[int]]=None) -> AsyncIterator[Any]:
+    '''
+    Stream the jobs of crud.iter_jobs through a serializer of the jobs, e.g.
+    partial(crud.get_jobs_ndjson, fields=fields)
+    '''
+    jobs = crud.iter_jobs(sync_session(db), offset=offset, limit=limit, after_id=after_id,
+                          updated_since=updated_since, created_since=created_since, fields=fields,
+                          job_ids=job_ids)
+    async for chunk in iterate(db, serialize(jobs)):
+        yield chunk
+
+async def stream_jobs_csv(db: AnySession, offset: int=0, limit: Optional[int]=None,
+                          after_id: Optional[int]=None, updated_since: Optional[datetime]=None,
+                          created_since: Optional[datetime]=None,
+                          job_ids: Optional[List[int]]=None) -> AsyncIterator[bytes]:
+    '''
+    Stream the jobs as CSV, with COPY when the driver supports it
+    '''
+    query = dict(offset=offset, limit=limit, after_id=after_id,
+                 updated_since=updated_since, created_since=created_since, job_ids=job_ids)
+    if crud.supports_copy(sync_session(db)):
+        chunks = iterate(db, crud.copy_jobs_csv(sync_session(db), **query))
+    else:
+        chunks = stream_jobs(db, crud.get_jobs_csv, **query)
+    async for chunk in chunks:
+        yield chunk
+
+async def get_job_version(db: AnySession, job_id: int) -> Optional[Tuple[int, datetime]]:
+    '''
+    Retrieve the id and the update time of the job with the given id
+    '''
+    return await run(db, crud.get_job_version, job_id=job_id)
+
+async def lookup_jobs(db: AnySession, job_ids: Optional[List[int]]=None,
+                      urls: Optional[List[str]]=None) -> List[Dict[str, Any]]:
+    '''
+    Retrieve the id, the url and the update time of the given jobs, as crud.lookup_jobs
+    '''
+    return await run(db, crud.lookup_jobs, job_ids=job_ids, urls=urls)
+
+async def get_jobs_version(db: AnySession) -> Tuple[int, Optional[datetime], Optional[float], int, Optional[datetime]]:
+    '''
+    Retrieve the values of crud.get_jobs_version
+    '''
+    return await run(db, crud.get_jobs_version)
+
+async def get_tombstones(db: AnySession, deleted_since: Optional[datetime]=None) -> List[schemas.JobTombstone]:
+    '''
+    Retrieve the records of the jobs deleted at or after the given time
+    '''
+    def read(session: Session) -> List[schemas.JobTombstone]:
+        tombstones = crud.get_tombstones(session, deleted_since=deleted_since)
+        return [schemas.JobTombstone.from_orm(tombstone) for tombstone in tombstones]
+    return await run(db, read)
+
+async def create_or_update_job(db: AnySession, job: schemas.Job) -> schemas.Job:
+    '''
+    Create or update the job and return the stored document
+    '''
+    def write(session: Session) -> schemas.Job:
+        return schemas.Job.from_orm(crud.create_or_update_job(session, job=job))
+    return await run(db, write)
+
+async def create_or_update_jobs(db: AnySession, jobs: List[schemas.Job]) -> List[schemas.JobStatus]:
+    '''
+    Create or update the given jobs in a single transaction
+    '''
+    return await run(db, crud.create_or_update_jobs, jobs=jobs)
+
+async def delete_job(db: AnySession, job_id: int) -> bool:
+    '''
+    Delete the job with the given id, returning whether it existed
+    '''
+    def delete(session: Session) -> bool:
+        job = crud.get_job(session, job_id=job_id)
+        if job is None:
+            return False
+        crud.delete_job(session, job=job)
+        return True
+    return await run(db, delete)
+
+async def count_values(db: AnySession, feature: str, top: Optional[int]=None,
+                       start: Optional[date]=None, end: Optional[date]=None) -> List[Dict[str, Any]]:
+    '''
+    Count the jobs for each value of the feature, as crud.count_values
+    '''
+    return await run(db, crud.count_values, feature=feature, top=top, start=start, end=end)
+
+async def count_value_pairs(db: AnySession, feature: str, by: str, top: Optional[int]=None,
+                            start: Optional[date]=None, end: Optional[date]=None) -> List[Dict[str, Any]]:
+    '''
+    Count the jobs for each pair of values, as crud.count_value_pairs
+    '''
+    return await run(db, crud.count_value_pairs, feature=feature, by=by, top=top, start=start, end=end)
+
+async def count_cooccurrences(db: AnySession, feature: str, top: Optional[int]=None,
+                              start: Optional[date]=None, end: Optional[date]=None) -> List[Dict[str, Any]]:
+    '''
+    Count the jobs for each pair of values of the feature, as crud.count_cooccurrences
+    '''
+    return await run(db, crud.count_cooccurrences, feature=feature, top=top, start=start, end=end)
+
+async def count_visa_relocation(db: AnySession, start: Optional[date]=None,
+                                end: Optional[date]=None) -> List[Dict[str, Any]]:
+    '''
+    Count the jobs per country, visa and relocation help, as crud.count_visa_relocation
+    '''
+    return await run(db, crud.count_visa_relocation, start=start, end=end)
+
+async def summarize_salaries(db: AnySession, feature: str, top: Optional[int]=None,
+                             start: Optional[date]=None, end: Optional[date]=None) -> List[Dict[str, Any]]:
+    '''
+    Summarize the salaries for each value of the feature, as crud.summarize_salaries
+    '''
+    return await run(db, crud.summarize_salaries, feature=feature, top=top, start=start, end=end)
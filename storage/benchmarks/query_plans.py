@@ -0,0 +1,98 @@
+'''
+Print the plans of the joins, lookups and deletes the storage service runs
+on the association tables, to compare them before and after a migration:
+
+    python benchmarks/query_plans.py              # before
+    alembic upgrade head
+    python benchmarks/query_plans.py              # after
+
+The database is read from DATABASE_URL, and the deletes are rolled back.
+'''
+import os
+import sys
+import json
+from typing import Any, Dict, List
+
+from sqlalchemy import create_engine, text
+
+# the benchmarked queries, with their parameters filled from the data
+QUERIES = {
+    'jobs with a skill': '''
+        SELECT job.id FROM job
+        JOIN job_skill ON job_skill.job_id = job.id
+        JOIN skill ON skill.id = job_skill.skill_id
+        WHERE skill.name = :skill''',
+    'technologies of a page of jobs': '''
+        SELECT job_technology.job_id, technology.name FROM job_technology
+        JOIN technology ON technology.id = job_technology.technology_id
+        WHERE job_technology.job_id = ANY(:job_ids)''',
+    'industries of the employers': '''
+        SELECT company_industry.company_id, industry.name FROM company_industry
+        JOIN industry ON industry.id = company_industry.industry_id
+        WHERE company_industry.company_id = ANY(:company_ids)''',
+    'skill counts of a week': '''
+        SELECT skill.name, count(*) FROM job
+        JOIN job_skill ON job_skill.job_id = job.id
+        JOIN skill ON skill.id = job_skill.skill_id
+        WHERE job.created >= :since
+        GROUP BY skill.name''',
+    'jobs updated since': '''
+        SELECT job.id FROM job WHERE job.updated >= :since ORDER BY job.id''',
+    'delete the roles of a job': '''
+        DELETE FROM job_role WHERE job_id = :job_id''',
+    'delete the uses of a skill': '''
+        DELETE FROM job_skill WHERE skill_id = :skill_id''',
+}
+
+
+def parameters(connection) -> Dict[str, Any]:
+    '''
+    Pick realistic parameters: the most common skill, a page of jobs and the
+    last week of jobs
+    '''
+    skill_id, skill = connection.execute(text('''
+        SELECT skill.id, skill.name FROM job_skill JOIN skill ON skill.id = job_skill.skill_id
+        GROUP BY skill.id, skill.name ORDER BY count(*) DESC LIMIT 1''')).first() or (0, '')
+    job_ids = [id for id, in connection.execute(text('SELECT id FROM job ORDER BY id LIMIT 500'))]
+    company_ids = [id for id, in connection.execute(text('SELECT id FROM company ORDER BY id LIMIT 500'))]
+    since = connection.execute(text("SELECT max(created) - interval '7 days' FROM job")).scalar()
+    return {'skill': skill, 'skill_id': skill_id, 'job_ids': job_ids, 'company_ids': company_ids,
+            'since': since, 'job_id': job_ids[0] if job_ids else 0}
+
+
+def scans(plan: Dict[str, Any]) -> List[str]:
+    '''
+    List the scans of a plan node and its children
+    '''
+    found = []
+    if 'Relation Name' in plan:
+        found.append('{} on {}'.format(plan['Node Type'], plan['Relation Name']))
+    for child in plan.get('Plans', []):
+        found.extend(scans(child))
+    return found
+
+
+def main() -> None:
+    engine = create_engine(os.environ['DATABASE_URL'])
+    with engine.connect() as connection:
+        connection.execute(text('ANALYZE'))
+        params = parameters(connection)
+        print('{:<32} {:>12} {:>10}  {}'.format('query', 'cost', 'ms', 'scans'))
+        for name, query in QUERIES.items():
+            transaction = connection.begin()
+            try:
+                result = connection.execute(
+                    text('EXPLAIN (ANALYZE, FORMAT JSON) ' + query), params).scalar()
+            finally:
+                transaction.rollback()
+            if isinstance(result, str):
+                result = json.loads(result)
+            plan = result[0]
+            print('{:<32} {:>12.1f} {:>10.3f}  {}'.format(
+                name, plan['Plan']['Total Cost'], plan['Execution Time'],
+                ', '.join(scans(plan['Plan']))))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+'''
+Compare the jobs per second serialized by the pydantic path of GET /jobs
+(database objects, schemas.Job.from_orm, jsonable_encoder and json) with the
+row based path (crud.get_job_documents and orjson) and with the stored
+documents (crud.get_job_document_texts), on the jobs of the database at
+DATABASE_URL:
+
+    python benchmarks/serialization.py [limit]
+
+The paths are timed from the query to the encoded body, and their outputs
+are checked to decode to the same documents.
+'''
+import os
+import sys
+import json
+import time
+from typing import Any, Callable, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+
+import crud, schemas
+from database import SessionLocal
+
+# the number of times each path is timed, keeping the best run
+REPEAT = 3
+
+
+def pydantic_path(db, limit) -> bytes:
+    jobs = crud.get_jobs(db, limit=limit)
+    return json.dumps(jsonable_encoder([schemas.Job.from_orm(job) for job in jobs])).encode()
+
+
+def rows_path(db, limit) -> bytes:
+    documents, _ = crud.get_job_documents(db, limit=limit)
+    return orjson.dumps(documents)
+
+
+def documents_path(db, limit) -> bytes:
+    texts, _ = crud.get_job_document_texts(db, limit=limit)
+    return ('[' + ','.join(texts) + ']').encode()
+
+
+def best_time(path: Callable, limit) -> Tuple[float, bytes]:
+    best, body = float('inf'), b''
+    for _ in range(REPEAT):
+        db = SessionLocal()
+        try:
+            start = time.perf_counter()
+            body = path(db, limit)
+            best = min(best, time.perf_counter() - start)
+        finally:
+            db.close()
+    return best, body
+
+
+def normalized(body: bytes) -> Any:
+    '''
+    Decode a body, sorting the listed values whose order is not defined
+    '''
+    documents = json.loads(body)
+    for doc in documents:
+        for field, value in doc.items():
+            if isinstance(value, list):
+                doc[field] = sorted(value)
+        if doc.get('employer'):
+            for field in ('industries', 'benefits'):
+                doc['employer'][field] = sorted(doc['employer'][field] or [])
+    return documents
+
+
+def main() -> None:
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    old_time, old_body = best_time(pydantic_path, limit)
+    new_time, new_body = best_time(rows_path, limit)
+    stored_time, stored_body = best_time(documents_path, limit)
+    count = len(json.loads(new_body))
+    print('jobs: {}'.format(count))
+    print('pydantic + json: {:10.0f} jobs/s'.format(count / old_time))
+    print('rows + orjson:   {:10.0f} jobs/s'.format(count / new_time))
+    print('stored docs:     {:10.0f} jobs/s'.format(count / stored_time))
+    print('same documents:  {}'.format(
+        normalized(old_body) == normalized(new_body) == normalized(stored_body)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+import os
+import math
+import hashlib
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from cache import response_cache
+
+logger = logging.getLogger(__name__)
+
+# the rate of false positives the existence filter is sized for
+EXISTENCE_FILTER_ERROR_RATE = float(os.environ.get('EXISTENCE_FILTER_ERROR_RATE', 0.01))
+# the least number of keys the existence filter is sized for
+EXISTENCE_FILTER_MIN_CAPACITY = int(os.environ.get('EXISTENCE_FILTER_MIN_CAPACITY', 100000))
+
+
+def id_key(job_id: int) -> str:
+    return 'id:{}'.format(job_id)
+
+
+def url_key(url: str) -> str:
+    return 'url:{}'.format(url)
+
+
+class BloomFilter:
+    '''
+    A set of strings that tells whether it may contain a string: it never
+    misses a string it contains, and wrongly claims others at about the
+    given error rate while it holds at most capacity strings
+    '''
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key: str) -> Iterable[int]:
+        # the bits of a key are derived from the two halves of a single digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, key: str) -> None:
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(key))
+
+    def error_rate(self) -> float:
+        '''
+        Estimate the rate of false positives with the strings added so far
+        '''
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class ExistenceFilter:
+    '''
+    A Bloom filter of the ids and urls of the stored jobs, which answers the
+    lookups of jobs that were never stored without reading the database.
+    It is loaded from the database and then follows the writes of this
+    process. The writes of other processes are detected by the version of
+    the jobs, which all the processes must share: once it moves on without
+    this process, the filter answers nothing until it is loaded again in the
+    background. Deleted jobs stay in the filter until it is loaded again
+    '''
+    def __init__(self, error_rate: float, version: Callable[[], Optional[int]]):
+        self.error_rate = error_rate
+        self.jobs_version = version
+        self.lock = threading.Lock()
+        self.bloom = None
+        self.version = None
+        self.loader = None
+        self.loading = False
+        # the keys and versions written while the filter is loaded
+        self.pending = None
+        self.counts = {'definite_misses': 0, 'maybe_hits': 0, 'false_positives': 0,
+                       'unavailable': 0, 'loads': 0, 'errors': 0}
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            self.counts[name] += 1
+
+    def start(self, loader: Callable[[], None]) -> None:
+        '''
+        Load the filter with the given function, which passes the keys of the
+        stored jobs to load, and keep it to load the filter again when needed
+        '''
+        self.loader = loader
+        self.reload(background=False)
+
+    def reload(self, background: bool=True) -> None:
+        with self.lock:
+            if self.loader is None or self.loading:
+                return
+            self.loading = True
+            self.pending = ([], [])
+
+        def run() -> None:
+            try:
+                self.loader()
+            except Exception:
+                logger.exception('Existence filter load failed')
+                self.count('errors')
+            finally:
+                with self.lock:
+                    self.loading = False
+                    self.pending = None
+
+        if background:
+            threading.Thread(target=run, daemon=True).start()
+        else:
+            run()
+
+    def load(self, count: int, keys: Iterable[str], version: Optional[int]) -> None:
+        '''
+        Replace the filter with one of the given keys of count jobs, read at
+        the given version of the jobs
+        '''
+        bloom = BloomFilter(max(EXISTENCE_FILTER_MIN_CAPACITY, 4 * count), self.error_rate)
+        for key in keys:
+            bloom.add(key)
+        with self.lock:
+            if self.pending is not None:
+                added, versions = self.pending
+                for key in added:
+                    bloom.add(key)
+                for written in versions:
+                    version = self.next_version(version, written)
+            self.bloom = bloom
+            self.version = version
+            self.counts['loads'] += 1
+
+    def next_version(self, version: Optional[int], written: Optional[int]) -> Optional[int]:
+        '''
+        Get the version of the filter after a write of this process, None
+        when other processes wrote in between
+        '''
+        if version is None or written is None or written != version + 1:
+            return None
+        return written
+
+    def add(self, keys: Iterable[str], version: Optional[int]) -> None:
+        '''
+        Add the keys of the jobs written by this process, which moved the
+        version of the jobs to the given one
+        '''
+        with self.lock:
+            if self.pending is not None:
+                self.pending[0].extend(keys)
+                self.pending[1].append(version)
+            if self.bloom is not None:
+                for key in keys:
+                    self.bloom.add(key)
+                self.version = self.next_version(self.version, version)
+
+    def current(self) -> bool:
+        '''
+        Tell whether the filter holds the keys of all the stored jobs
+        '''
+        if self.bloom is None:
+            return False
+        return self.version is not None and self.jobs_version() == self.version
+
+    def check(self, key: str) -> Optional[bool]:
+        '''
+        Tell whether a job may exist: False if it certainly does not, True if
+        it may, or None when the filter cannot tell
+        '''
+        return self.check_many([key])[key]
+
+    def check_many(self, keys: Iterable[str]) -> Dict[str, Optional[bool]]:
+        '''
+        Tell whether each of the given jobs may exist, as check does, reading
+        the version of the jobs once for all of them
+        '''
+        keys = set(keys)
+        if not keys:
+            return {}
+        if not self.current():
+            self.count('unavailable')
+            self.reload()
+            return dict.fromkeys(keys)
+        bloom = self.bloom
+        if bloom.count > bloom.capacity:
+            self.reload()
+        answers = {key: key in bloom for key in keys}
+        hits = sum(answers.values())
+        with self.lock:
+            self.counts['maybe_hits'] += hits
+            self.counts['definite_misses'] += len(answers) - hits
+        return answers
+
+    def record(self, answer: Optional[bool], exists: bool) -> None:
+        '''
+        Count the answer of check as a false positive if the job did not exist
+        '''
+        if answer and not exists:
+            self.count('false_positives')
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            counts = dict(self.counts)
+            bloom = self.bloom
+            loading = self.loading
+        negatives = counts['false_positives'] + counts['definite_misses']
+        stats = {'loaded': bloom is not None,
+                 'loading': loading,
+                 'current': self.current(),
+                 'false_positive_rate': counts['false_positives'] / negatives if negatives else 0.0,
+                 **counts}
+        if bloom is not None:
+            stats.update({'keys': bloom.count,
+                          'capacity': bloom.capacity,
+                          'bytes': len(bloom.bits),
+                          'hashes': bloom.hashes,
+                          'estimated_false_positive_rate': bloom.error_rate()})
+        return stats
+
+
+# keep an existence filter unless EXISTENCE_FILTER is turned off
+EXISTENCE_FILTER = os.environ.get('EXISTENCE_FILTER', 'true').lower() in ('1', 'true', 'yes')
+
+
+def make_existence_filter() -> Optional[ExistenceFilter]:
+    '''
+    Keep an existence filter only with the response cache, whose version of
+    the jobs, committed along with every write, tells when the filter misses
+    jobs written by any of the processes
+    '''
+    if not EXISTENCE_FILTER or response_cache is None:
+        return None
+    return ExistenceFilter(EXISTENCE_FILTER_ERROR_RATE, response_cache.version)
+
+
+existence_filter = make_existence_filter()
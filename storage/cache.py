@@ -0,0 +1,200 @@
+import os
+import json
+import threading
+import hashlib
+import logging
+import redis
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+from sqlalchemy import select
+
+import models
+from database import engine
+
+logger = logging.getLogger(__name__)
+
+# the seconds a cached response is kept in Redis
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 3600))
+# the largest response body that is cached, in bytes
+RESPONSE_CACHE_MAX_BODY = int(os.environ.get('RESPONSE_CACHE_MAX_BODY', 32 * 1024 * 1024))
+# the total size of the bodies kept by the in-memory cache, in bytes
+RESPONSE_CACHE_MEMORY = int(os.environ.get('RESPONSE_CACHE_MEMORY', 256 * 1024 * 1024))
+
+# a cached response: status code, headers and body
+Entry = Tuple[int, Dict[str, str], bytes]
+
+
+class MemoryBackend:
+    '''
+    Responses kept in the memory of the process, bounded by the total size of
+    their bodies. They are dropped once a newer version of the jobs is seen
+    '''
+    name = 'memory'
+
+    def __init__(self, maxbytes: int):
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.version = None
+        self.lock = threading.Lock()
+
+    def discard(self, version: int) -> None:
+        with self.lock:
+            if version != self.version:
+                # the entries of older versions can no longer be hit
+                self.entries.clear()
+                self.size = 0
+                self.version = version
+
+    def get(self, key: str) -> Optional[Entry]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, entry: Entry) -> None:
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key)[2])
+            self.entries[key] = entry
+            self.size += len(entry[2])
+            while self.size > self.maxbytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted[2])
+
+
+class RedisBackend:
+    '''
+    Responses kept in Redis, shared by all the workers. Entries of older
+    versions expire
+    '''
+    name = 'redis'
+
+    def __init__(self, client: Any, ttl: int):
+        self.client = client
+        self.ttl = ttl
+
+    def discard(self, version: int) -> None:
+        pass
+
+    def get(self, key: str) -> Optional[Entry]:
+        value = self.client.get('storage:response:' + key)
+        if value is None:
+            return None
+        # a line of JSON with the status and the headers, followed by the body
+        head, body = value.split(b'\n', 1)
+        status, headers = json.loads(head)
+        return status, headers, body
+
+    def set(self, key: str, entry: Entry) -> None:
+        status, headers, body = entry
+        value = json.dumps([status, headers]).encode() + b'\n' + body
+        self.client.set('storage:response:' + key, value, ex=self.ttl)
+
+
+class ResponseCache:
+    '''
+    A cache of the responses of the read endpoints, keyed by a version of the
+    jobs, the path and the query parameters. The version is the counter of
+    the job_version table, which a commit that changes the jobs bumps in its
+    own transaction: it is seen with the changes by every process, and the
+    cached responses of earlier versions are never hit again. Failures of the
+    backend are counted and treated as misses
+    '''
+    def __init__(self, backend: Any, engine: Any):
+        self.backend = backend
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'misses': 0, 'stores': 0, 'too_large': 0,
+                       'invalidations': 0, 'errors': 0}
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            self.counts[name] += 1
+
+    def key(self, version: int, path: str, query: str) -> str:
+        digest = hashlib.sha1('{}?{}'.format(path, query).encode()).hexdigest()
+        return '{}:{}'.format(version, digest)
+
+    def get(self, path: str, query: str) -> Tuple[Optional[str], Optional[Entry]]:
+        '''
+        Look up the response of a request, returning the key to store it
+        under and the cached entry, or None on a miss
+        '''
+        try:
+            version = self.read_version()
+            self.backend.discard(version)
+            key = self.key(version, path, query)
+            entry = self.backend.get(key)
+        except Exception:
+            logger.exception('Response cache lookup failed')
+            self.count('errors')
+            return None, None
+        self.count('hits' if entry is not None else 'misses')
+        return key, entry
+
+    def set(self, key: str, entry: Entry) -> None:
+        if len(entry[2]) > RESPONSE_CACHE_MAX_BODY:
+            self.count('too_large')
+            return
+        try:
+            self.backend.set(key, entry)
+        except Exception:
+            logger.exception('Response cache store failed')
+            self.count('errors')
+            return
+        self.count('stores')
+
+    def read_version(self) -> int:
+        with self.engine.connect() as connection:
+            return connection.execute(select(models.job_version.c.version)).scalar() or 0
+
+    def version(self) -> Optional[int]:
+        '''
+        Get the current version of the jobs, or None if it cannot be read
+        '''
+        try:
+            return self.read_version()
+        except Exception:
+            logger.exception('Response cache version lookup failed')
+            self.count('errors')
+            return None
+
+    def publish(self, version: int) -> None:
+        '''
+        Drop the responses of this process older than the version committed
+        by one of its writes, without waiting for the next lookup to read it
+        '''
+        self.backend.discard(version)
+        self.count('invalidations')
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            counts = dict(self.counts)
+        lookups = counts['hits'] + counts['misses']
+        return {'backend': self.backend.name,
+                'hit_ratio': counts['hits'] / lookups if lookups else 0.0,
+                **counts}
+
+
+def make_backend() -> Any:
+    '''
+    Use Redis at REDIS_URL when it is set and reachable, otherwise the memory
+    of the process
+    '''
+    url = os.environ.get('REDIS_URL')
+    if url:
+        try:
+            client = redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+            client.ping()
+            return RedisBackend(client, RESPONSE_CACHE_TTL)
+        except Exception:
+            logger.warning('Redis at %s is not available, caching responses in memory', url)
+    return MemoryBackend(RESPONSE_CACHE_MEMORY)
+
+
+# cache the responses unless RESPONSE_CACHE is turned off
+RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', 'true').lower() in ('1', 'true', 'yes')
+
+response_cache = ResponseCache(make_backend(), engine) if RESPONSE_CACHE else None
@@ -1,12 +1,281 @@
 from os import name
-from sqlalchemy.orm import Session
-from sqlalchemy import and_
-from typing import List, Optional, Generator, Dict, Any, Tuple
-from csv import DictWriter
+import os
+import threading
+from collections import Counter, OrderedDict
+from sqlalchemy import event
+from sqlalchemy.orm import Session, aliased, joinedload, selectinload, undefer
+from sqlalchemy import ARRAY, REAL, Date, Text, and_, or_, bindparam, case, cast, func, literal_column, select, text, tuple_, Table
+from sqlalchemy import column as sql_column, table as sql_table
+from sqlalchemy.dialects.postgresql import JSONB, array, insert
+from sqlalchemy.exc import SQLAlchemyError
+from typing import List, Optional, Generator, Dict, Any, Tuple, Iterable, Set
+import csv
+from itertools import combinations, product
+from datetime import date, datetime, timedelta, timezone
+import base64
+import binascii
 import io
+import json
+import orjson
 # import pandas as pd
 
+import pyarrow as pa
+import pyarrow.parquet as pq
+
 import models, schemas
+from bloom import existence_filter, id_key, url_key
+from cache import response_cache
+
+# the maximum number of rows sent with a single statement
+BATCH_SIZE = 1000
+
+# the first key of the advisory locks taken on job ids by lock_jobs
+JOB_LOCK_SPACE = 1
+
+# the number of search results in a page when no limit is given
+SEARCH_PAGE_SIZE = 20
+
+# the largest number of search results in a page
+SEARCH_MAX_PAGE_SIZE = 100
+
+# the highlighted fragments of the descriptions in the search results
+HEADLINE_OPTIONS = 'StartSel=<b>, StopSel=</b>, MaxWords=35, MinWords=15, MaxFragments=2'
+
+# the number of rows fetched at a time from a server side cursor
+STREAM_BATCH_SIZE = 500
+
+# the columns of the CSV export of the jobs collection
+CSV_FIELDS = ['id', 'title', 'technologies',
+              'employer_name', 'employer_size',
+              'employer_industries', 'employer_company_type',
+              'experience', 'roles', 'job_types',
+              'joel_test', 'skills', 'created',
+              'location_longitude', 'location_latitude', 'location_country_code',
+              'salary_minimum', 'salary_maximum',
+              'visa', 'equity', 'relocation',
+              'benefits', 'remote']
+
+# the columns of the CSV export with one row for each of the listed values
+# of a job, in the order they are combined
+CSV_LISTED_FIELDS = ['technologies', 'employer_industries', 'experience', 'roles',
+                     'job_types', 'joel_test', 'skills', 'remote']
+
+# the size in bytes of the chunks of the CSV export
+CSV_CHUNK_SIZE = 64 * 1024
+
+# the fields of a serialized job
+JOB_FIELDS = list(schemas.Job.__fields__)
+
+# the fields of the stored documents of the jobs, which leave out the description
+DOCUMENT_FIELDS = [field for field in JOB_FIELDS if field != 'description']
+
+# the columns of the columnar exports of the jobs collection, named as by
+# pandas.json_normalize on the JSON export
+ARROW_NAME = pa.dictionary(pa.int32(), pa.string())
+ARROW_SCHEMA = pa.schema([
+    ('id', pa.int64()),
+    ('url', pa.string()),
+    ('title', pa.string()),
+    ('employer.url', pa.string()),
+    ('employer.name', ARROW_NAME),
+    ('employer.industries', pa.list_(ARROW_NAME)),
+    ('employer.size', ARROW_NAME),
+    ('employer.company_type', ARROW_NAME),
+    ('employer.benefits', pa.list_(ARROW_NAME)),
+    ('location.latitude', pa.float64()),
+    ('location.longitude', pa.float64()),
+    ('location.country_code', ARROW_NAME),
+    ('remote', pa.list_(ARROW_NAME)),
+    ('equity', pa.bool_()),
+    ('salary.minimum', pa.int64()),
+    ('salary.maximum', pa.int64()),
+    ('visa', pa.bool_()),
+    ('relocation', pa.bool_()),
+    ('experience', pa.list_(ARROW_NAME)),
+    ('job_types', pa.list_(ARROW_NAME)),
+    ('roles', pa.list_(ARROW_NAME)),
+    ('technologies', pa.list_(ARROW_NAME)),
+    ('skills', pa.list_(ARROW_NAME)),
+    ('joel_test', pa.list_(ARROW_NAME)),
+    ('benefits', pa.list_(ARROW_NAME)),
+    ('description', pa.large_string()),
+    ('created', pa.timestamp('us')),
+    ('updated', pa.timestamp('us')),
+])
+
+# the named objects of a job, mapped to their model, the association table
+# and the foreign key column in the association table
+JOB_DIMENSIONS = {
+    'remote': (models.Remote, models.job_remote, 'remote_id'),
+    'experience': (models.Experience, models.job_experience, 'experience_id'),
+    'job_types': (models.JobType, models.job_job_type, 'job_type_id'),
+    'roles': (models.Role, models.job_role, 'role_id'),
+    'technologies': (models.Technology, models.job_technology, 'technology_id'),
+    'skills': (models.Skill, models.job_skill, 'skill_id'),
+    'joel_test': (models.JoelTest, models.job_joel_test, 'joel_test_id'),
+}
+
+# the listed values of a job, mapped to the collection holding them
+JOB_COLLECTIONS = {
+    'remote': models.Job.job_remotes,
+    'experience': models.Job.job_experiences,
+    'job_types': models.Job.job_job_types,
+    'roles': models.Job.job_roles,
+    'technologies': models.Job.job_technologies,
+    'skills': models.Job.job_skills,
+    'joel_test': models.Job.job_joel_tests,
+}
+
+# the co-occurrence tables of the listed values
+COOCCURRENCE_TABLES = {
+    'technologies': models.technology_cooccurrence,
+    'roles': models.role_cooccurrence,
+    'skills': models.skill_cooccurrence,
+}
+
+# the columns of the job table that are fields of a job document
+JOB_COLUMNS = ['url', 'title', 'equity', 'visa', 'relocation', 'description', 'created', 'updated']
+
+# the columns of the objects nested in a job document
+EMPLOYER_COLUMNS = ['url', 'name', 'size', 'company_type']
+LOCATION_COLUMNS = ['latitude', 'longitude', 'country_code']
+SALARY_COLUMNS = ['minimum', 'maximum']
+
+# the features that can be aggregated by the statistics
+STATS_FEATURES = [*JOB_DIMENSIONS, 'industries', 'country']
+
+# the tables of objects shared between jobs, mapped to their unique key columns
+DIMENSION_KEYS = {
+    models.Company.__table__: ('name', 'url'),
+    models.Location.__table__: ('latitude', 'longitude'),
+    models.Salary.__table__: ('minimum', 'maximum'),
+    models.Industry.__table__: ('name',),
+    models.Benefit.__table__: ('name',),
+    **{model.__table__: ('name',) for model, _, _ in JOB_DIMENSIONS.values()}
+}
+
+
+class DimensionCache:
+    '''
+    A bounded mapping of the keys of the dimension tables to ids, shared by
+    all the sessions of the process. The ids resolved by a session are kept
+    pending until its transaction commits and are dropped if it rolls back,
+    so the cache never holds ids of rows that were not committed
+    '''
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def pending(db: Session) -> Dict[Tuple[str, Tuple], int]:
+        return db.info.setdefault('dimension_ids', {})
+
+    def get(self, db: Session, table: str, key: Tuple) -> Optional[int]:
+        '''
+        Get the id of the row with the given key, or None on a miss
+        '''
+        with self.lock:
+            id = self.entries.get((table, key))
+            if id is not None:
+                self.entries.move_to_end((table, key))
+            else:
+                id = self.pending(db).get((table, key))
+            if id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return id
+
+    def add(self, db: Session, table: str, ids: Dict[Tuple, int]) -> None:
+        '''
+        Keep the given ids pending until the transaction of the session commits
+        '''
+        pending = self.pending(db)
+        for key, id in ids.items():
+            pending[(table, key)] = id
+
+    def update(self, entries: Dict[Tuple[str, Tuple], int]) -> None:
+        '''
+        Add the given committed entries, evicting the least recently used ones
+        '''
+        with self.lock:
+            self.entries.update(entries)
+            for entry in entries:
+                self.entries.move_to_end(entry)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {'size': len(self.entries), 'maxsize': self.maxsize,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+dimension_cache = DimensionCache(int(os.environ.get('DIMENSION_CACHE_SIZE', 100000)))
+
+@event.listens_for(Session, 'after_commit')
+def _commit_dimension_ids(db: Session) -> None:
+    dimension_cache.update(db.info.pop('dimension_ids', {}))
+
+@event.listens_for(Session, 'after_transaction_end')
+def _discard_dimension_ids(db: Session, transaction) -> None:
+    if transaction.parent is None:
+        db.info.pop('dimension_ids', None)
+
+@event.listens_for(Session, 'before_commit')
+def _bump_jobs_version(db: Session) -> None:
+    if db.info.get('jobs_changed') and 'jobs_version' not in db.info:
+        db.info['jobs_version'] = bump_jobs_version(db)
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_responses(db: Session) -> None:
+    added = db.info.pop('jobs_added', [])
+    version = db.info.pop('jobs_version', None)
+    if db.info.pop('jobs_changed', False):
+        if response_cache is not None:
+            response_cache.publish(version)
+        if existence_filter is not None:
+            existence_filter.add(added, version)
+
+@event.listens_for(Session, 'after_transaction_end')
+def _discard_jobs_changed(db: Session, transaction) -> None:
+    if transaction.parent is None:
+        db.info.pop('jobs_changed', None)
+        db.info.pop('jobs_added', None)
+        db.info.pop('jobs_version', None)
+
+def bump_jobs_version(db: Session) -> int:
+    '''
+    Count a commit that changes the jobs in the job_version table, through
+    the connection of the committing transaction. The row stays locked until
+    the commit, so the new version is only seen along with the changes.
+    Returns the new version
+    '''
+    table = models.job_version
+    stmt = insert(table).values(id=1, version=1)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.id], set_={'version': table.c.version + 1})
+    return db.execute(stmt.returning(table.c.version)).scalar()
+
+def warm_dimension_cache(db: Session) -> None:
+    '''
+    Load the ids of the dimension tables in the cache, up to its size
+    '''
+    entries = {}
+    for table, key_columns in DIMENSION_KEYS.items():
+        q = select(table.c.id, *[table.c[column] for column in key_columns])
+        for row in db.execute(q.limit(dimension_cache.maxsize - len(entries))):
+            entries[(table.name, tuple(row[1:]))] = row[0]
+        if len(entries) >= dimension_cache.maxsize:
+            break
+    dimension_cache.update(entries)
 
 def unwind(doc: Dict[str, Any]) -> Generator[Dict[str, Any], None, None]:
     '''
@@ -79,13 +348,13 @@ def get_salary_by_value(db: Session, minimum: int, maximum: int) -> Optional[mod
 
 def create_salary(db: Session, salary: schemas.Salary) -> models.Salary:
     '''
-    Create a salary object and insert it in the database
+    Create a salary object in the current transaction, unless one with the
+    same range of values exists, and return it
     '''
-    db_salary = models.Salary(minimum=salary.minimum, maximum=salary.maximum)
-    db.add(db_salary)
-    db.commit()
-    db.refresh(db_salary)
-    return db_salary
+    ids, _ = get_or_create_ids(
+        db=db, table=models.Salary.__table__, key_columns=('minimum', 'maximum'),
+        rows={salary_key(salary): salary.dict()})
+    return db.get(models.Salary, ids[salary_key(salary)])
 
 def get_location_by_coords(db: Session, latitude: float, longitude: float) -> Optional[models.Location]:
     '''
@@ -98,13 +367,13 @@ def get_location_by_coords(db: Session, latitude: float, longitude: float) -> Op
 
 def create_location(db: Session, location: schemas.Location) -> models.Location:
     '''
-    Create a Location object and insert it in the database
+    Create a Location object in the current transaction, unless one with the
+    same coordinates exists, and return it
     '''
-    db_location = models.Location(**(location.dict()))
-    db.add(db_location)
-    db.commit()
-    db.refresh(db_location)
-    return db_location
+    ids, _ = get_or_create_ids(
+        db=db, table=models.Location.__table__, key_columns=('latitude', 'longitude'),
+        rows={location_key(location): location.dict()})
+    return db.get(models.Location, ids[location_key(location)])
 
 def get_exprerience_by_name(db: Session, name: str) -> Optional[models.Experience]:
     '''
@@ -116,13 +385,11 @@ def get_exprerience_by_name(db: Session, name: str) -> Optional[models.Experienc
 
 def create_experience(db: Session, experience: str) -> models.Experience:
     '''
-    Create an Experience object and insert it in the database
+    Create an Experience object in the current transaction, unless one with the
+    same name exists, and return it
     '''
-    db_experience = models.Experience(name=experience)
-    db.add(db_experience)
-    db.commit()
-    db.refresh(db_experience)
-    return db_experience
+    ids = get_or_create_name_ids(db=db, model=models.Experience, names=[experience])
+    return db.get(models.Experience, ids[experience])
 
 def get_industry_by_name(db: Session, name: str) -> Optional[models.Industry]:
     '''
@@ -134,13 +401,11 @@ def get_industry_by_name(db: Session, name: str) -> Optional[models.Industry]:
 
 def create_industry(db: Session, industry: str) -> models.Industry:
     '''
-    Create an Industry object and insert it in the database
+    Create an Industry object in the current transaction, unless one with the
+    same name exists, and return it
     '''
-    db_industry = models.Industry(name=industry)
-    db.add(db_industry)
-    db.commit()
-    db.refresh(db_industry)
-    return db_industry
+    ids = get_or_create_name_ids(db=db, model=models.Industry, names=[industry])
+    return db.get(models.Industry, ids[industry])
 
 def get_company_by_name_url(db: Session, name: str, url: str) -> Optional[models.Company]:
     '''
@@ -153,25 +418,11 @@ def get_company_by_name_url(db: Session, name: str, url: str) -> Optional[models
 
 def create_company(db: Session, company: schemas.Company) -> models.Company:
     '''
-    Create a Company object and insert it in the database
-    '''
-    industries = []
-    if company.industries is not None:
-        # industries = []
-        for industry in company.industries:
-            db_industry = get_industry_by_name(db=db, name=industry)
-            if db_industry is None:
-                db_industry = create_industry(db=db, industry=industry)
-            industries.append(db_industry)
-    db_company = models.Company(name=company.name,
-                                url=company.url,
-                                size=company.size,
-                                company_type=company.company_type,
-                                company_industries=industries)
-    db.add(db_company)
-    db.commit()
-    db.refresh(db_company)
-    return db_company
+    Create a Company object in the current transaction, unless one with the
+    same name and url exists, and return it
+    '''
+    ids = get_or_create_company_ids(db=db, companies=[company])
+    return db.get(models.Company, ids[company_key(company)])
 
 def get_role_by_name(db: Session, name: str) -> Optional[models.Role]:
     '''
@@ -183,13 +434,11 @@ def get_role_by_name(db: Session, name: str) -> Optional[models.Role]:
 
 def create_role(db: Session, role: str) -> models.Role:
     '''
-    Create a Role object and insert it in the database
+    Create a Role object in the current transaction, unless one with the
+    same name exists, and return it
     '''
-    db_role = models.Role(name=role)
-    db.add(db_role)
-    db.commit()
-    db.refresh(db_role)
-    return db_role
+    ids = get_or_create_name_ids(db=db, model=models.Role, names=[role])
+    return db.get(models.Role, ids[role])
 
 def get_job_type_by_name(db: Session, name: str) -> Optional[models.JobType]:
     '''
@@ -201,13 +450,11 @@ def get_job_type_by_name(db: Session, name: str) -> Optional[models.JobType]:
 
 def create_job_type(db: Session, job_type: str) -> models.JobType:
     '''
-    Create a JobType object and insert it in the database
+    Create a JobType object in the current transaction, unless one with the
+    same name exists, and return it
     '''
-    db_job_type = models.JobType(name=job_type)
-    db.add(db_job_type)
-    db.commit()
-    db.refresh(db_job_type)
-    return db_job_type
+    ids = get_or_create_name_ids(db=db, model=models.JobType, names=[job_type])
+    return db.get(models.JobType, ids[job_type])
 
 def get_skill_by_name(db: Session, name: str) -> Optional[models.Skill]:
     '''
@@ -219,13 +466,11 @@ def get_skill_by_name(db: Session, name: str) -> Optional[models.Skill]:
 
 def create_skill(db: Session, skill: str) -> models.Skill:
     '''
-    Create a Skill object and insert it in the database
+    Create a Skill object in the current transaction, unless one with the
+    same name exists, and return it
     '''
-    db_skill = models.Skill(name=skill)
-    db.add(db_skill)
-    db.commit()
-    db.refresh(db_skill)
-    return db_skill
+    ids = get_or_create_name_ids(db=db, model=models.Skill, names=[skill])
+    return db.get(models.Skill, ids[skill])
 
 def get_technology_by_name(db: Session, name: str) -> Optional[models.Technology]:
     '''
@@ -237,13 +482,11 @@ def get_technology_by_name(db: Session, name: str) -> Optional[models.Technology
 
 def create_technology(db: Session, technology: str) -> models.Technology:
     '''
-    Create a Technology object and insert it in the database
+    Create a Technology object in the current transaction, unless one with the
+    same name exists, and return it
     '''
-    db_technology = models.Technology(name=technology)
-    db.add(db_technology)
-    db.commit()
-    db.refresh(db_technology)
-    return db_technology
+    ids = get_or_create_name_ids(db=db, model=models.Technology, names=[technology])
+    return db.get(models.Technology, ids[technology])
 
 def get_joel_test_by_name(db: Session, name: str) -> Optional[models.JoelTest]:
     '''
@@ -255,13 +498,11 @@ def get_joel_test_by_name(db: Session, name: str) -> Optional[models.JoelTest]:
 
 def create_joel_test(db: Session, joel_test: str) -> models.JoelTest:
     '''
-    Create a JoelTest object and insert it in the database
+    Create a JoelTest object in the current transaction, unless one with the
+    same name exists, and return it
     '''
-    db_joel_test = models.JoelTest(name=joel_test)
-    db.add(db_joel_test)
-    db.commit()
-    db.refresh(db_joel_test)
-    return db_joel_test
+    ids = get_or_create_name_ids(db=db, model=models.JoelTest, names=[joel_test])
+    return db.get(models.JoelTest, ids[joel_test])
 
 def get_remote_by_name(db: Session, name: str) -> Optional[models.Remote]:
     '''
@@ -273,13 +514,11 @@ def get_remote_by_name(db: Session, name: str) -> Optional[models.Remote]:
 
 def create_remote(db: Session, remote: str) -> models.Remote:
     '''
-    Create a Remote object and insert it in the database
+    Create a Remote object in the current transaction, unless one with the
+    same name exists, and return it
     '''
-    db_remote = models.Remote(name=remote)
-    db.add(db_remote)
-    db.commit()
-    db.refresh(db_remote)
-    return db_remote
+    ids = get_or_create_name_ids(db=db, model=models.Remote, names=[remote])
+    return db.get(models.Remote, ids[remote])
 
 def get_benefit_by_name(db: Session, name: str) -> Optional[models.Benefit]:
     '''
@@ -291,13 +530,11 @@ def get_benefit_by_name(db: Session, name: str) -> Optional[models.Benefit]:
 
 def create_benefit(db: Session, benefit: str) -> models.Benefit:
     '''
-    Create a Benefit object and insert it in the database
+    Create a Benefit object in the current transaction, unless one with the
+    same name exists, and return it
     '''
-    db_benefit = models.Benefit(name=benefit)
-    db.add(db_benefit)
-    db.commit()
-    db.refresh(db_benefit)
-    return db_benefit
+    ids = get_or_create_name_ids(db=db, model=models.Benefit, names=[benefit])
+    return db.get(models.Benefit, ids[benefit])
 
 def get_job(db: Session, job_id: int) -> Optional[models.Job]:
     '''
@@ -311,173 +548,1262 @@ def get_job_by_url(db: Session, url: str) -> Optional[models.Job]:
     '''
     return db.query(models.Job).filter(models.Job.url==url).one_or_none()
 
-def get_jobs(db: Session, offset: int=0, limit: Optional[int]=None) -> List[models.Job]:
+def parse_fields(fields: Optional[str], exclude: Optional[str]) -> Optional[List[str]]:
+    '''
+    Get the fields of a job to serialize from comma separated lists of fields
+    to include and to exclude, or None if neither is given.
+    Raises ValueError on an unknown field
+    '''
+    if fields is None and exclude is None:
+        return None
+    included = [field for field in (fields or '').split(',') if field]
+    excluded = [field for field in (exclude or '').split(',') if field]
+    unknown = set(included + excluded) - set(JOB_FIELDS)
+    if unknown:
+        raise ValueError("Unknown fields: {}".format(', '.join(sorted(unknown))))
+    return [field for field in JOB_FIELDS
+            if (fields is None or field in included) and field not in excluded]
+
+def parse_ids(ids: str) -> List[int]:
+    '''
+    Get the job ids of a comma separated list.
+    Raises ValueError on an id that is not an integer
+    '''
+    try:
+        return [int(id) for id in ids.split(',') if id.strip()]
+    except ValueError:
+        raise ValueError("Invalid job ids, expected comma separated integers")
+
+def job_load_options(fields: Optional[Iterable[str]]=None) -> List[Any]:
+    '''
+    Get the loader options that fetch every relationship serialized with a
+    Job in a fixed number of queries, regardless of the number of jobs.
+    When fields are given, only what they need is loaded, and the
+    description is only loaded when it is one of them
+    '''
+    fields = set(fields if fields is not None else JOB_FIELDS)
+    options = []
+    if 'employer' in fields:
+        options.append(joinedload(models.Job.employer).selectinload(models.Company.company_industries))
+        options.append(joinedload(models.Job.employer).selectinload(models.Company.company_benefits))
+    if 'location' in fields:
+        options.append(joinedload(models.Job.location))
+    if 'salary' in fields:
+        options.append(joinedload(models.Job.salary))
+    for attribute, collection in JOB_COLLECTIONS.items():
+        if attribute in fields:
+            options.append(selectinload(collection))
+    if 'description' in fields:
+        options.append(undefer(models.Job.description))
+    return options
+
+def job_dict(job: models.Job, fields: Iterable[str]) -> Dict[str, Any]:
+    '''
+    Get the given fields of a Job database object, in the layout of schemas.Job
+    '''
+    doc = {}
+    for field in fields:
+        if field == 'employer':
+            employer = job.employer
+            doc[field] = {'url': employer.url,
+                          'name': employer.name,
+                          'industries': list(employer.industries),
+                          'size': employer.size,
+                          'company_type': employer.company_type,
+                          'benefits': list(employer.benefits)} if employer is not None else None
+        elif field == 'location':
+            location = job.location
+            doc[field] = {'latitude': location.latitude,
+                          'longitude': location.longitude,
+                          'country_code': location.country_code} if location is not None else None
+        elif field == 'salary':
+            salary = job.salary
+            doc[field] = {'minimum': salary.minimum,
+                          'maximum': salary.maximum} if salary is not None else None
+        elif field in JOB_COLLECTIONS:
+            doc[field] = list(getattr(job, field))
+        else:
+            doc[field] = getattr(job, field, None)
+    return doc
+
+def json_default(value: Any) -> Any:
+    '''
+    Encode the values that the json module does not know as pydantic does
     '''
-    Retrieve a list of Job documents from the database
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError("{} is not JSON serializable".format(type(value).__name__))
+
+def encode_cursor(job_id: int) -> str:
     '''
-    q = db.query(models.Job).offset(offset)
+    Encode the position after the job with the given id as an opaque cursor
+    '''
+    return base64.urlsafe_b64encode(json.dumps({'id': job_id}).encode()).decode()
+
+def decode_cursor(cursor: str) -> Optional[int]:
+    '''
+    Decode the id of the last job before the position of the given cursor,
+    None for an empty cursor that points to the start of the collection.
+    Raises ValueError if the cursor is not valid
+    '''
+    if not cursor:
+        return None
+    try:
+        job_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))['id']
+    except (ValueError, TypeError, KeyError, binascii.Error):
+        raise ValueError("Invalid cursor")
+    if not isinstance(job_id, int):
+        raise ValueError("Invalid cursor")
+    return job_id
+
+def encode_search_cursor(rank: float, job_id: int) -> str:
+    '''
+    Encode the position after the search result with the given rank and job
+    id as an opaque cursor
+    '''
+    return base64.urlsafe_b64encode(json.dumps({'rank': rank, 'id': job_id}).encode()).decode()
+
+def decode_search_cursor(cursor: str) -> Optional[Tuple[float, int]]:
+    '''
+    Decode the rank and the job id of the last result before the position of
+    the given cursor, None for an empty cursor that points to the first result.
+    Raises ValueError if the cursor is not valid
+    '''
+    if not cursor:
+        return None
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        rank, job_id = position['rank'], position['id']
+    except (ValueError, TypeError, KeyError, binascii.Error):
+        raise ValueError("Invalid cursor")
+    if not isinstance(rank, (int, float)) or not isinstance(job_id, int):
+        raise ValueError("Invalid cursor")
+    return float(rank), job_id
+
+def filter_jobs(q: Any, after_id: Optional[int]=None, updated_since: Optional[datetime]=None,
+                created_since: Optional[datetime]=None, job_ids: Optional[List[int]]=None) -> Any:
+    '''
+    Restrict a query or a select of jobs to those after the job with the given
+    id, to those updated or created at or after the given times, and to
+    those with the given ids
+    '''
+    if after_id is not None:
+        q = q.filter(models.Job.id > after_id)
+    if updated_since is not None:
+        q = q.filter(models.Job.updated >= naive_utc(updated_since))
+    if created_since is not None:
+        q = q.filter(models.Job.created >= naive_utc(created_since))
+    if job_ids is not None:
+        q = q.filter(models.Job.id.in_(job_ids))
+    return q
+
+def get_jobs(db: Session, offset: int=0, limit: Optional[int]=None,
+             after_id: Optional[int]=None, updated_since: Optional[datetime]=None,
+             created_since: Optional[datetime]=None, fields: Optional[List[str]]=None,
+             job_ids: Optional[List[int]]=None) -> List[models.Job]:
+    '''
+    Retrieve a list of Job documents from the database ordered by id, along
+    with all their related objects, or only those needed for the given fields.
+    When after_id is given, the list starts right after the job with this id
+    (keyset pagination). When updated_since or created_since is given, only
+    the jobs updated or created since then are listed, and when job_ids is
+    given only the jobs with these ids
+    '''
+    q = db.query(models.Job).options(*job_load_options(fields)).order_by(models.Job.id)
+    q = filter_jobs(q, after_id=after_id, updated_since=updated_since, created_since=created_since,
+                    job_ids=job_ids)
+    q = q.offset(offset)
     if limit is not None:
         return q.limit(limit).all()
     else:
         return q.all()
     # return db.query(models.Job).offset(offset).limit(limit).all()
 
+def get_job_documents(db: Session, offset: int=0, limit: Optional[int]=None,
+                      after_id: Optional[int]=None, updated_since: Optional[datetime]=None,
+                      created_since: Optional[datetime]=None, fields: Optional[List[str]]=None,
+                      job_ids: Optional[List[int]]=None) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    '''
+    Retrieve the jobs of get_jobs, or the jobs with the given ids, as plain
+    dicts in the layout of schemas.Job (or of the given fields of it), built
+    straight from the result rows without loading database objects.
+    Returns the documents and the id of the last job
+    '''
+    fields = list(fields) if fields is not None else JOB_FIELDS
+    job = models.Job.__table__
+    company = models.Company.__table__
+    location = models.Location.__table__
+    salary = models.Salary.__table__
+    columns = [job.c.id.label('id')]
+    joined = job
+    for field in fields:
+        if field in JOB_COLUMNS:
+            columns.append(job.c[field])
+        elif field == 'employer':
+            columns.append(company.c.id.label('employer_id'))
+            columns.extend(company.c[name].label('employer_' + name) for name in EMPLOYER_COLUMNS)
+            joined = joined.outerjoin(company, company.c.id == job.c.employer_id)
+        elif field == 'location':
+            columns.append(location.c.id.label('location_id'))
+            columns.extend(location.c[name].label('location_' + name) for name in LOCATION_COLUMNS)
+            joined = joined.outerjoin(location, location.c.id == job.c.location_id)
+        elif field == 'salary':
+            columns.append(salary.c.id.label('salary_id'))
+            columns.extend(salary.c[name].label('salary_' + name) for name in SALARY_COLUMNS)
+            joined = joined.outerjoin(salary, salary.c.id == job.c.salary_id)
+    q = select(*columns).select_from(joined).order_by(job.c.id)
+    q = filter_jobs(q, after_id=after_id, updated_since=updated_since, created_since=created_since,
+                    job_ids=job_ids)
+    q = q.offset(offset)
+    if limit is not None:
+        q = q.limit(limit)
+    rows = db.execute(q).all()
+    ids = [row.id for row in rows]
+    # the names of the listed values of the jobs and of their employers
+    values = {}
+    for attribute in JOB_COLLECTIONS:
+        if attribute in fields:
+            model, assoc, column = JOB_DIMENSIONS[attribute]
+            values[attribute] = names_by_owner(db, assoc.c.job_id, model, assoc.c[column], ids)
+    if 'employer' in fields:
+        employer_ids = list({row.employer_id for row in rows if row.employer_id is not None})
+        industries = names_by_owner(db, models.company_industry.c.company_id, models.Industry,
+                                    models.company_industry.c.industry_id, employer_ids)
+        benefits = names_by_owner(db, models.company_benefit.c.company_id, models.Benefit,
+                                  models.company_benefit.c.benefit_id, employer_ids)
+    documents = []
+    for row in rows:
+        doc = {}
+        for field in fields:
+            if field == 'id' or field in JOB_COLUMNS:
+                doc[field] = row._mapping[field]
+            elif field in values:
+                doc[field] = values[field].get(row.id, [])
+            elif field == 'employer':
+                doc[field] = {'url': row.employer_url,
+                              'name': row.employer_name,
+                              'industries': industries.get(row.employer_id, []),
+                              'size': row.employer_size,
+                              'company_type': row.employer_company_type,
+                              'benefits': benefits.get(row.employer_id, [])} if row.employer_id is not None else None
+            elif field == 'location':
+                doc[field] = {'latitude': row.location_latitude,
+                              'longitude': row.location_longitude,
+                              'country_code': row.location_country_code} if row.location_id is not None else None
+            elif field == 'salary':
+                doc[field] = {'minimum': row.salary_minimum,
+                              'maximum': row.salary_maximum} if row.salary_id is not None else None
+            else:
+                doc[field] = None
+        documents.append(doc)
+    return documents, ids[-1] if ids else None
+
+def get_job_document_texts(db: Session, offset: int=0, limit: Optional[int]=None,
+                           after_id: Optional[int]=None, updated_since: Optional[datetime]=None,
+                           created_since: Optional[datetime]=None, fields: Optional[List[str]]=None,
+                           job_ids: Optional[List[int]]=None) -> Tuple[List[str], Optional[int]]:
+    '''
+    Retrieve the jobs of get_jobs, or those with the given ids, as JSON
+    texts read from their stored documents, with the fields that are not
+    given removed by the database and the description added to them when it
+    is given. The documents that are missing or older than their job are
+    built with get_job_documents.
+    Returns the texts and the id of the last job
+    '''
+    job = models.Job.__table__
+    document = job.c.document
+    included = fields if fields is not None else JOB_FIELDS
+    excluded = [field for field in JOB_FIELDS if field not in included]
+    if excluded:
+        document = document.op('-')(cast(array(excluded), ARRAY(Text)))
+    # the descriptions are kept out of the documents, and only read when asked for
+    if 'description' in included:
+        document = document.op('||')(
+            func.jsonb_build_object(literal_column("'description'"), job.c.description))
+    q = select(job.c.id, cast(document, Text),
+               func.coalesce(job.c.document_updated == job.c.updated, False)).order_by(job.c.id)
+    q = filter_jobs(q, after_id=after_id, updated_since=updated_since, created_since=created_since,
+                    job_ids=job_ids)
+    q = q.offset(offset)
+    if limit is not None:
+        q = q.limit(limit)
+    rows = db.execute(q).all()
+    stale = [id for id, _, current in rows if not current]
+    # the built documents are matched to their jobs by their own id, since a
+    # job deleted in between is missing from them
+    with_id = included if 'id' in included else ['id'] + list(included)
+    built = {}
+    for chunk in chunks(stale):
+        documents, _ = get_job_documents(db, fields=with_id, job_ids=chunk)
+        for doc in documents:
+            id = doc['id'] if 'id' in included else doc.pop('id')
+            built[id] = orjson.dumps(doc).decode()
+    texts = [text if current else built[id] for id, text, current in rows
+             if current or id in built]
+    return texts, rows[-1][0] if rows else None
+
+def search_jobs(db: Session, q: str, limit: int=SEARCH_PAGE_SIZE,
+                after: Optional[Tuple[float, int]]=None, recent: Optional[int]=None) -> List[Dict[str, Any]]:
+    '''
+    Search the titles and descriptions of the jobs with a web search query,
+    e.g. 'python -django' or '"data engineer" or analyst', through the GIN
+    index of their search vectors. The results are ordered by rank and id,
+    starting after the given (rank, id) position, and the headline of each
+    result highlights the matching words of its description.
+    When recent is given, only that number of the most recently created
+    matches are ranked, so that common words do not rank most of the jobs
+    '''
+    job = models.Job.__table__
+    # the configuration is a literal, for asyncpg to resolve the functions
+    config = literal_column("'{}'::regconfig".format(models.SEARCH_CONFIG))
+    query = func.websearch_to_tsquery(config, q)
+    matches = job.c.search_vector.op('@@')(query)
+    rank = func.ts_rank(job.c.search_vector, query)
+    ranked = select(job.c.id, rank.label('rank'))
+    if recent is not None:
+        candidates = select(job.c.id).where(matches).order_by(
+            job.c.created.desc(), job.c.id.desc()).limit(recent).subquery()
+        ranked = ranked.join(candidates, candidates.c.id == job.c.id)
+    else:
+        ranked = ranked.where(matches)
+    if after is not None:
+        # the ranks are real numbers, compared with the rank of the cursor as read
+        after_rank, after_id = cast(after[0], REAL), after[1]
+        ranked = ranked.where(or_(rank < after_rank, and_(rank == after_rank, job.c.id > after_id)))
+    page = ranked.order_by(rank.desc(), job.c.id).limit(limit).subquery()
+    # the headlines are only built for the page, as they parse the descriptions
+    description = func.regexp_replace(func.coalesce(job.c.description, ''), '<[^>]*>', ' ', 'g')
+    headline = func.ts_headline(config, description, query, HEADLINE_OPTIONS)
+    q = select(job.c.id, job.c.url, job.c.title, page.c.rank, headline.label('headline'),
+               job.c.created, job.c.updated).join(page, page.c.id == job.c.id).order_by(
+                   page.c.rank.desc(), job.c.id)
+    return [dict(row._mapping) for row in db.execute(q)]
+
+def refresh_documents(db: Session, job_ids: List[int]) -> None:
+    '''
+    Store the documents of the given jobs, as they are in the current
+    transaction and without their description, stamped with the update time
+    of the jobs
+    '''
+    job = models.Job.__table__
+    stmt = job.update().where(job.c.id == bindparam('job_id')).values(
+        document=cast(bindparam('text'), JSONB), document_updated=job.c.updated)
+    for chunk in chunks(job_ids):
+        documents, _ = get_job_documents(db, fields=DOCUMENT_FIELDS, job_ids=chunk)
+        db.execute(stmt, [{'job_id': doc['id'], 'text': orjson.dumps(doc).decode()}
+                          for doc in documents])
+
+def rebuild_documents(db: Session, stale_only: bool=True) -> int:
+    '''
+    Store the documents of all the jobs, or only of those whose document is
+    missing or older than the job, committing after each batch.
+    Returns the number of documents stored
+    '''
+    job = models.Job.__table__
+    count = 0
+    after_id = None
+    while True:
+        q = select(job.c.id).order_by(job.c.id).limit(BATCH_SIZE)
+        if after_id is not None:
+            q = q.where(job.c.id > after_id)
+        if stale_only:
+            q = q.where(job.c.document_updated.is_distinct_from(job.c.updated))
+        ids = db.execute(q).scalars().all()
+        if not ids:
+            return count
+        refresh_documents(db, ids)
+        db.commit()
+        count += len(ids)
+        after_id = ids[-1]
+
+def names_by_owner(db: Session, owner: Any, model: Any, foreign_key: Any,
+                   owner_ids: List[int]) -> Dict[int, List[str]]:
+    '''
+    Get the names of the objects associated with each of the given owners,
+    e.g. the skills of jobs, from the owner and foreign key columns of an
+    association table
+    '''
+    names = {}
+    for chunk in chunks(owner_ids):
+        q = select(owner, model.name).join(model, model.id == foreign_key).where(owner.in_(chunk))
+        for owner_id, name in db.execute(q):
+            names.setdefault(owner_id, []).append(name)
+    return names
+
+def iter_jobs(db: Session, offset: int=0, limit: Optional[int]=None,
+              after_id: Optional[int]=None, updated_since: Optional[datetime]=None,
+              created_since: Optional[datetime]=None, fields: Optional[List[str]]=None,
+              job_ids: Optional[List[int]]=None) -> Generator[models.Job, None, None]:
+    '''
+    Generate the Job documents of get_jobs one at a time, reading them from a
+    server side cursor in batches so that only one batch is held in memory
+    '''
+    q = db.query(models.Job).options(*job_load_options(fields)).order_by(models.Job.id)
+    q = filter_jobs(q, after_id=after_id, updated_since=updated_since, created_since=created_since,
+                    job_ids=job_ids)
+    q = q.offset(offset)
+    if limit is not None:
+        q = q.limit(limit)
+    q = q.execution_options(stream_results=True).yield_per(STREAM_BATCH_SIZE)
+    for job in q:
+        yield job
+        # detach the job once it has been consumed, to keep memory flat
+        db.expunge(job)
+
+def get_job_version(db: Session, job_id: int) -> Optional[Tuple[int, datetime]]:
+    '''
+    Retrieve the id and the update time of the job with the given id, without
+    loading the job, or None if there is no such job
+    '''
+    known = existence_filter.check(id_key(job_id)) if existence_filter is not None else None
+    if known is False:
+        return None
+    version = db.execute(
+        select(models.Job.id, models.Job.updated).where(models.Job.id==job_id)
+    ).first()
+    if known:
+        existence_filter.record(known, version is not None)
+    return version
+
+def lookup_jobs(db: Session, job_ids: Optional[List[int]]=None,
+                urls: Optional[List[str]]=None) -> List[Dict[str, Any]]:
+    '''
+    Retrieve the id, the url and the update time of the jobs with the given
+    ids or urls, without loading the jobs, with an indexed query per batch.
+    Jobs that do not exist are left out, and the rest are ordered by id.
+    The ids and urls the existence filter has never seen are not looked up
+    '''
+    job = models.Job.__table__
+    job_ids, urls = set(job_ids or []), set(urls or [])
+    # the filter is checked once for all the keys, reading the version of the jobs once
+    checked = {}
+    if existence_filter is not None:
+        checked = existence_filter.check_many(
+            [id_key(id) for id in job_ids] + [url_key(url) for url in urls])
+    found = {}
+    for key, values, filter_key in ((job.c.id, job_ids, id_key), (job.c.url, urls, url_key)):
+        answers = {value: checked[filter_key(value)] for value in values} if checked else {}
+        values = {value for value in values if answers.get(value) is not False}
+        present = set()
+        for chunk in chunks(list(values)):
+            q = select(job.c.id, job.c.url, job.c.updated).where(key.in_(chunk))
+            for row in db.execute(q):
+                found[row.id] = dict(row._mapping)
+                present.add(row._mapping[key.name])
+        for value, answer in answers.items():
+            existence_filter.record(answer, value in present)
+    return [found[id] for id in sorted(found)]
+
+def load_existence_filter(db: Session) -> None:
+    '''
+    Load the existence filter with the ids and urls of the stored jobs
+    '''
+    # the version is read first, so that the writes made during the load
+    # leave the filter out of date rather than missing their jobs
+    version = response_cache.version() if response_cache is not None else None
+    count = db.execute(select(func.count()).select_from(models.Job)).scalar()
+    q = select(models.Job.id, models.Job.url).execution_options(stream_results=True)
+    rows = db.execute(q).yield_per(STREAM_BATCH_SIZE)
+    existence_filter.load(count, (key for id, url in rows for key in (id_key(id), url_key(url))), version)
+
+def get_jobs_version(db: Session) -> Tuple[int, Optional[datetime], Optional[float], int, Optional[datetime]]:
+    '''
+    Retrieve values that change whenever a job is created, updated or
+    deleted: the number of jobs, their latest update time and the sum of their
+    update times, the number of deleted jobs and the latest deletion time
+    '''
+    tombstones = models.JobTombstone
+    return db.execute(select(
+        func.count(models.Job.id),
+        func.max(models.Job.updated),
+        func.sum(func.extract('epoch', models.Job.updated)),
+        select(func.count(tombstones.id)).scalar_subquery(),
+        select(func.max(tombstones.deleted)).scalar_subquery(),
+    )).one()
+
+def get_tombstones(db: Session, deleted_since: Optional[datetime]=None) -> List[models.JobTombstone]:
+    '''
+    Retrieve the records of the deleted jobs, optionally only those deleted
+    at or after the given time
+    '''
+    q = db.query(models.JobTombstone).order_by(models.JobTombstone.deleted)
+    if deleted_since is not None:
+        q = q.filter(models.JobTombstone.deleted >= naive_utc(deleted_since))
+    return q.all()
+
 def create_or_update_job(db: Session, job: schemas.Job) -> models.Job:
     '''
     Given a job schema, create a Job object in the database or update a
     Job object from the database if such one already exists with the given id
-    from the schema
-    '''
-    # get employer
-    db_company = None
-    if job.employer is not None:
-        db_company = get_company_by_name_url(
-            db=db, name=job.employer.name, url=job.employer.url)
-        if db_company is None:
-            db_company = create_company(db=db, company=job.employer)
-    # get location
-    db_location = None
-    if job.location is not None:
-        db_location = get_location_by_coords(
-            db=db,
-            latitude=job.location.latitude,
-            longitude=job.location.longitude)
-            # country_code=job.location.country_code)
-        if db_location is None:
-            db_location = create_location(db=db, location=job.location)
-    # get salary
-    db_salary = None
-    if job.salary is not None:
-        db_salary = get_salary_by_value(
-            db=db, minimum=job.salary.minimum, maximum=job.salary.maximum)
-        if db_salary is None:
-            db_salary = create_salary(db=db, salary=job.salary)
-    # get roles
-    db_roles = []
-    if job.roles is not None:
-        # db_roles = []
-        for role in job.roles:
-            db_role = get_role_by_name(db=db, name=role)
-            if db_role is None:
-                db_role = create_role(db=db, role=role)
-            db_roles.append(db_role)
-    # get experience
-    db_experience = []
-    if job.experience is not None:
-        # db_experience = []
-        for experience in job.experience:
-            db_exp = get_exprerience_by_name(db=db, name=experience)
-            if db_exp is None:
-                db_exp = create_experience(db=db, experience=experience)
-            db_experience.append(db_exp)
-    # get job type
-    db_job_types = []
-    if job.job_types is not None:
-        # db_job_types = []
-        for job_type in job.job_types:
-            db_job_type = get_job_type_by_name(db=db, name=job_type)
-            if db_job_type is None:
-                db_job_type = create_job_type(db=db, job_type=job_type)
-            db_job_types.append(db_job_type)
-    # get skill
-    db_skills = []
-    if job.skills is not None:
-        # db_skills = []
-        for skill in job.skills:
-            db_skill = get_skill_by_name(db=db, name=skill)
-            if db_skill is None:
-                db_skill = create_skill(db=db, skill=skill)
-            db_skills.append(db_skill)
-    # get technology
-    db_technologies = []
-    if job.technologies is not None:
-        # db_technologies = []
-        for tech in job.technologies:
-            db_tech = get_technology_by_name(db=db, name=tech)
-            if db_tech is None:
-                db_tech = create_technology(db=db, technology=tech)
-            db_technologies.append(db_tech)
-    # get joel test
-    db_joel_tests = []
-    if job.joel_test is not None:
-        # db_joel_tests = []
-        for joel_test in job.joel_test:
-            db_joel_test = get_joel_test_by_name(db=db, name=joel_test)
-            if db_joel_test is None:
-                db_joel_test = create_joel_test(db=db, joel_test=joel_test)
-            db_joel_tests.append(db_joel_test)
-    # get remote (cannot be None)
-    db_remotes = []
-    for remote in job.remote:
-        db_remote = get_remote_by_name(db=db, name=remote)
-        if db_remote is None:
-            db_remote = create_remote(db=db, remote=remote)
-        db_remotes.append(db_remote)
-    # get benefits
-    db_benefits = []
-    if job.benefits is not None:
-        for benefit in job.benefits:
-            db_benefit = get_benefit_by_name(db=db, name=benefit)
-            if db_benefit is None:
-                db_benefit = create_benefit(db=db, benefit=benefit)
-            db_benefits.append(db_benefit)
-
-    # check if job exists
-    db_job = db.query(models.Job).filter(models.Job.id==job.id).one_or_none()
-
-    if db_job is None:
-        # create job
-        db_job = models.Job(id = job.id)
-        db.add(db_job)
-    db_job.title = job.title
-    db_job.url = job.url
-    db_job.description = job.description
-    db_job.visa = job.visa
-    db_job.relocation = job.relocation
-    db_job.created = job.created
-    db_job.updated = job.updated
-    db_job.equity = job.equity
-    db_job.employer = db_company
-    db_job.job_roles = db_roles
-    db_job.job_skills = db_skills
-    db_job.job_experiences = db_experience
-    db_job.salary = db_salary
-    db_job.location = db_location
-    db_job.job_job_types = db_job_types
-    db_job.job_technologies = db_technologies
-    db_job.job_joel_tests = db_joel_tests
-    db_job.job_remotes = db_remotes
-    db.commit()
-    db.refresh(db_job)
-    return db_job
+    from the schema. Everything is written in a single transaction.
+    Raises ValueError if the job cannot be written
+    '''
+    try:
+        status, = write_jobs(db=db, jobs=[job])
+        if status.status == 'failed':
+            raise ValueError(status.detail)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return get_job(db=db, job_id=job.id)
 
-def get_jobs_csv(jobs: List[models.Job]) -> Generator[str, None, None]:
+def chunks(values: List[Any], size: int=BATCH_SIZE) -> Generator[List[Any], None, None]:
     '''
-    Given a list of Job database objects, generates rows of comma separated values
+    Split the given list of values in lists of at most size values
+    '''
+    for i in range(0, len(values), size):
+        yield values[i:i+size]
+
+def get_or_create_ids(db: Session, table: Table, key_columns: Tuple[str, ...],
+                      rows: Dict[Tuple, Dict[str, Any]]) -> Tuple[Dict[Tuple, int], Set[Tuple]]:
+    '''
+    Map the key of each given row to the id of the matching row of the table,
+    inserting the rows that do not exist yet. Rows inserted concurrently by
+    another transaction are skipped on conflict and selected afterwards.
+    Returns the mapping and the keys of the inserted rows
+    '''
+    ids = {}
+    inserted = set()
+    columns = [table.c[column] for column in key_columns]
+    for key in rows:
+        id = dimension_cache.get(db=db, table=table.name, key=key)
+        if id is not None:
+            ids[key] = id
+
+    def select_ids(keys: List[Tuple]) -> None:
+        for chunk in chunks(keys):
+            q = select(table.c.id, *columns).where(
+                columns[0].in_({key[0] for key in chunk}))
+            for row in db.execute(q):
+                key = tuple(row[1:])
+                if key in rows:
+                    ids[key] = row[0]
+
+    select_ids(list(rows.keys() - ids.keys()))
+    # insert in a fixed order so that concurrent writers lock rows in the same order
+    missing = sorted(rows.keys() - ids.keys(), key=str)
+    for chunk in chunks(missing):
+        stmt = insert(table).values(
+            [rows[key] for key in chunk]
+        ).on_conflict_do_nothing().returning(table.c.id, *columns)
+        for row in db.execute(stmt):
+            key = tuple(row[1:])
+            ids[key] = row[0]
+            inserted.add(key)
+    missing = list(rows.keys() - ids.keys())
+    if missing:
+        select_ids(missing)
+    dimension_cache.add(db=db, table=table.name, ids=ids)
+    return ids, inserted
+
+def get_or_create_name_ids(db: Session, model: models.Base, names: Iterable[str]) -> Dict[str, int]:
+    '''
+    Map each given name to the id of the object of the model with this name,
+    creating the objects that do not exist yet
+    '''
+    ids, _ = get_or_create_ids(
+        db=db, table=model.__table__, key_columns=('name',),
+        rows={(name,): {'name': name} for name in names})
+    return {key[0]: id for key, id in ids.items()}
+
+def company_key(company: schemas.Company) -> Tuple[str, Optional[str]]:
+    '''
+    Get the unique key of a company
+    '''
+    return (company.name, company.url)
+
+def location_key(location: schemas.Location) -> Tuple[float, float]:
+    '''
+    Get the unique key of a location
+    '''
+    return (location.latitude, location.longitude)
+
+def salary_key(salary: schemas.Salary) -> Tuple[int, int]:
+    '''
+    Get the unique key of a salary
+    '''
+    return (salary.minimum, salary.maximum)
+
+def get_or_create_company_ids(db: Session, companies: List[schemas.Company]) -> Dict[Tuple, int]:
+    '''
+    Map the key of each given company to the id of the Company object,
+    creating the companies that do not exist yet along with their industries
+    '''
+    company_ids, new_companies = get_or_create_ids(
+        db=db, table=models.Company.__table__, key_columns=('name', 'url'),
+        rows={company_key(company): {'name': company.name,
+                                     'url': company.url,
+                                     'size': company.size,
+                                     'company_type': company.company_type}
+              for company in companies})
+    # industries are only set on companies created now
+    company_industries = {}
+    for company in companies:
+        if company_key(company) in new_companies:
+            company_industries[company_key(company)] = dict.fromkeys(
+                company.industries or [])
+    industry_ids = get_or_create_name_ids(
+        db=db, model=models.Industry,
+        names={name for names in company_industries.values() for name in names})
+    rows = [{'company_id': company_ids[key], 'industry_id': industry_ids[name]}
+            for key, names in company_industries.items() for name in names]
+    for chunk in chunks(rows):
+        db.execute(models.company_industry.insert(), chunk)
+    return company_ids
+
+def naive_utc(value: datetime) -> datetime:
+    '''
+    Convert the given datetime to a naive one in UTC, as stored in the database
+    '''
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+def lock_jobs(db: Session, job_ids: List[int]) -> Dict[int, Any]:
+    '''
+    Lock the given job ids until the end of the transaction, whether the jobs
+    are stored or not, so that what is read from them stays current until
+    the commit. The ids are locked in order, so that concurrent writers do
+    not deadlock.
+    Returns the update and creation times of each stored job
+    '''
+    job_ids = sorted(set(job_ids))
+    stored = {}
+    for chunk in chunks(job_ids):
+        db.execute(text('SELECT pg_advisory_xact_lock(:space, id) FROM unnest(CAST(:ids AS integer[])) AS id'),
+                   {'space': JOB_LOCK_SPACE, 'ids': chunk})
+        q = select(models.Job.id, models.Job.updated, models.Job.created).where(
+            models.Job.id.in_(chunk)).order_by(models.Job.id).with_for_update()
+        stored.update((row.id, row) for row in db.execute(q))
+    return stored
+
+def write_jobs(db: Session, jobs: List[schemas.Job]) -> List[schemas.JobStatus]:
+    '''
+    Create or update the given jobs within the current transaction, resolving
+    the referenced objects of the whole batch with a few set based queries.
+    Jobs that are not newer than the stored ones are left unchanged, and only
+    the associations that changed are written.
+    Returns the status of each given job
+    '''
+    statuses = [None] * len(jobs)
+    # a repeated id is written once, with its last occurrence
+    last = {job.id: i for i, job in enumerate(jobs)}
+    for i, job in enumerate(jobs):
+        if last[job.id] != i:
+            statuses[i] = schemas.JobStatus(
+                id=job.id, status='failed', detail='Job is repeated later in the batch')
+    # find the existing jobs and skip those that are not newer than the stored ones
+    stored = lock_jobs(db=db, job_ids=list(last))
+    candidates = []
+    for i in sorted(last.values()):
+        job = jobs[i]
+        if job.id in stored and stored[job.id].updated is not None \
+                and naive_utc(job.updated) <= stored[job.id].updated:
+            statuses[i] = schemas.JobStatus(id=job.id, status='unchanged')
+        else:
+            candidates.append(i)
+    # a url can only belong to one job
+    url_ids = {}
+    for i in candidates:
+        url_ids.setdefault(jobs[i].url, jobs[i].id)
+    for chunk in chunks(list(url_ids)):
+        q = select(models.Job.id, models.Job.url).where(models.Job.url.in_(chunk))
+        for id, url in db.execute(q):
+            url_ids[url] = id
+    valid = []
+    for i in candidates:
+        job = jobs[i]
+        if url_ids[job.url] != job.id:
+            statuses[i] = schemas.JobStatus(
+                id=job.id, status='failed',
+                detail='Job url belongs to job {}'.format(url_ids[job.url]))
+        else:
+            valid.append(i)
+    if not valid:
+        return statuses
+    batch = [jobs[i] for i in valid]
+    existing = stored.keys()
+    # jobs created again are no longer deleted
+    created = [job.id for job in batch if job.id not in existing]
+    for chunk in chunks(created):
+        db.execute(models.JobTombstone.__table__.delete().where(
+            models.JobTombstone.id.in_(chunk)))
+    # get employers
+    company_ids = get_or_create_company_ids(
+        db=db, companies=[job.employer for job in batch if job.employer is not None])
+    # get locations
+    location_ids, _ = get_or_create_ids(
+        db=db, table=models.Location.__table__, key_columns=('latitude', 'longitude'),
+        rows={location_key(job.location): job.location.dict()
+              for job in batch if job.location is not None})
+    # get salaries
+    salary_ids, _ = get_or_create_ids(
+        db=db, table=models.Salary.__table__, key_columns=('minimum', 'maximum'),
+        rows={salary_key(job.salary): job.salary.dict()
+              for job in batch if job.salary is not None})
+    # get the named objects
+    dimension_ids = {}
+    for attribute, (model, _, _) in JOB_DIMENSIONS.items():
+        dimension_ids[attribute] = get_or_create_name_ids(
+            db=db, model=model,
+            names={name for job in batch for name in (getattr(job, attribute) or [])})
+    # create or update the jobs, unless they are not newer than the stored ones
+    rows = [{'id': job.id,
+             'url': job.url,
+             'title': job.title,
+             'employer_id': company_ids[company_key(job.employer)] if job.employer is not None else None,
+             'location_id': location_ids[location_key(job.location)] if job.location is not None else None,
+             'salary_id': salary_ids[salary_key(job.salary)] if job.salary is not None else None,
+             'equity': job.equity,
+             'visa': job.visa,
+             'relocation': job.relocation,
+             'description': job.description,
+             'created': naive_utc(job.created),
+             'updated': naive_utc(job.updated)} for job in batch]
+    job_table = models.Job.__table__
+    stmt = insert(job_table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[job_table.c.id],
+        set_={column: stmt.excluded[column] for column in rows[0] if column != 'id'},
+        where=or_(job_table.c.updated.is_(None), job_table.c.updated < stmt.excluded.updated))
+    written = set()
+    for chunk in chunks(sorted(rows, key=lambda row: row['id'])):
+        written.update(db.execute(stmt.values(chunk).returning(job_table.c.id)).scalars())
+    for i in valid:
+        if jobs[i].id not in written:
+            statuses[i] = schemas.JobStatus(id=jobs[i].id, status='unchanged')
+    valid = [i for i in valid if jobs[i].id in written]
+    if not valid:
+        return statuses
+    batch = [jobs[i] for i in valid]
+    updated = [job.id for job in batch if job.id in existing]
+    # the value pairs are counted on the days the jobs were created before and after the write
+    old_days = {job_id: stored[job_id].created for job_id in updated}
+    new_days = {job.id: naive_utc(job.created) for job in batch}
+    removed_pairs, added_pairs = {}, {}
+    # insert and delete only the associations that changed
+    for attribute, (_, table, column) in JOB_DIMENSIONS.items():
+        current = set()
+        for chunk in chunks(updated):
+            q = select(table.c.job_id, table.c[column]).where(table.c.job_id.in_(chunk))
+            current.update(tuple(row) for row in db.execute(q))
+        incoming = {(job.id, dimension_ids[attribute][name])
+                    for job in batch for name in (getattr(job, attribute) or [])}
+        removed = sorted(current - incoming)
+        for chunk in chunks(removed):
+            db.execute(table.delete().where(
+                tuple_(table.c.job_id, table.c[column]).in_(chunk)))
+        added = [{'job_id': job_id, column: id}
+                 for job_id, id in sorted(incoming - current)]
+        for chunk in chunks(added):
+            db.execute(table.insert(), chunk)
+        if attribute in COOCCURRENCE_TABLES:
+            removed_pairs[attribute] = count_pairs(associations=current, days=old_days)
+            added_pairs[attribute] = count_pairs(associations=incoming, days=new_days)
+    update_cooccurrences(db=db, added=added_pairs, removed=removed_pairs)
+    refresh_documents(db=db, job_ids=[job.id for job in batch])
+    # the cached responses are invalidated, and the jobs added to the
+    # existence filter, when the transaction commits
+    db.info['jobs_changed'] = True
+    db.info.setdefault('jobs_added', []).extend(
+        key for job in batch for key in (id_key(job.id), url_key(job.url)))
+    for i in valid:
+        statuses[i] = schemas.JobStatus(
+            id=jobs[i].id, status='updated' if jobs[i].id in existing else 'created')
+    return statuses
+
+def cooccurrence_select(attribute: str, job_ids: Optional[List[int]]=None) -> Any:
+    '''
+    Select the number of jobs per day of creation and pair of values of the
+    listed attribute, among the given jobs or all of them
+    '''
+    _, table, column = JOB_DIMENSIONS[attribute]
+    first, second = table.alias(), table.alias()
+    day = cast(models.Job.created, Date)
+    keys = (day, first.c[column], second.c[column])
+    q = select(*keys, func.count()).select_from(models.Job).join(
+        first, first.c.job_id == models.Job.id
+    ).join(
+        second, and_(second.c.job_id == models.Job.id, first.c[column] < second.c[column])
+    ).where(models.Job.created.isnot(None)).group_by(*keys).order_by(*keys)
+    if job_ids is not None:
+        q = q.where(models.Job.id.in_(job_ids))
+    return q
+
+def stored_cooccurrences(db: Session, job_ids: List[int]) -> Dict[str, Counter]:
+    '''
+    Count the value pairs of the given jobs, as they are currently stored,
+    per listed attribute and (day, first_id, second_id)
+    '''
+    counts = {attribute: Counter() for attribute in COOCCURRENCE_TABLES}
+    for attribute in COOCCURRENCE_TABLES:
+        for chunk in chunks(job_ids):
+            counts[attribute].update({tuple(row)[:-1]: row[-1] for row in
+                                      db.execute(cooccurrence_select(attribute=attribute, job_ids=chunk))})
+    return counts
+
+def count_pairs(associations: Iterable[Tuple[int, int]], days: Dict[int, Optional[datetime]]) -> Counter:
+    '''
+    Count the pairs of values of the given (job id, value id) associations
+    per (day, first_id, second_id), on the day each job was created
+    '''
+    values = {}
+    for job_id, id in associations:
+        values.setdefault(job_id, set()).add(id)
+    counts = Counter()
+    for job_id, ids in values.items():
+        if days[job_id] is not None:
+            day = days[job_id].date()
+            counts.update((day, *pair) for pair in combinations(sorted(ids), 2))
+    return counts
+
+def update_cooccurrences(db: Session, added: Optional[Dict[str, Counter]]=None,
+                         removed: Optional[Dict[str, Counter]]=None) -> None:
+    '''
+    Add the net change of the value pairs, added minus removed, to the
+    co-occurrence tables, and delete the pairs no job has any more.
+    The rows are written in the order of their keys with a single upsert
+    per table, so that concurrent writers lock them in the same order
+    '''
+    for attribute, table in COOCCURRENCE_TABLES.items():
+        delta = Counter((added or {}).get(attribute))
+        delta.subtract((removed or {}).get(attribute))
+        rows = [{'day': day, 'first_id': first_id, 'second_id': second_id, 'count': count}
+                for (day, first_id, second_id), count in sorted(delta.items()) if count != 0]
+        keys = (table.c.day, table.c.first_id, table.c.second_id)
+        for chunk in chunks(rows):
+            stmt = insert(table).values(chunk)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=keys, set_={'count': table.c.count + stmt.excluded.count})
+            emptied = [tuple(row)[:-1] for row in db.execute(stmt.returning(*keys, table.c.count))
+                       if row.count <= 0]
+            for empty in chunks(emptied):
+                db.execute(table.delete().where(tuple_(*keys).in_(empty)))
+
+def create_or_update_jobs(db: Session, jobs: List[schemas.Job]) -> List[schemas.JobStatus]:
+    '''
+    Create or update the given jobs in a single transaction and return the
+    status of each one. If the transaction fails, every job is reported as failed
+    '''
+    try:
+        statuses = write_jobs(db=db, jobs=jobs)
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        detail = str(getattr(e, 'orig', None) or e)
+        statuses = [schemas.JobStatus(id=job.id, status='failed', detail=detail)
+                    for job in jobs]
+    return statuses
+
+
+def job_json(job: models.Job, fields: Optional[List[str]]=None) -> str:
+    '''
+    Serialize a Job database object, or only the given fields of it, to JSON
+    '''
+    if fields is None:
+        return schemas.Job.from_orm(job).json()
+    return json.dumps(job_dict(job, fields), default=json_default)
+
+def get_jobs_ndjson(jobs: Iterable[models.Job], fields: Optional[List[str]]=None) -> Generator[str, None, None]:
+    '''
+    Given Job database objects, generates a line of JSON for each one
+    '''
+    for job in jobs:
+        yield job_json(job, fields) + '\n'
+
+def get_jobs_json(jobs: Iterable[models.Job], fields: Optional[List[str]]=None) -> Generator[str, None, None]:
+    '''
+    Given Job database objects, generates a JSON array of them piece by piece
+    '''
+    separator = '['
+    for job in jobs:
+        yield separator + job_json(job, fields)
+        separator = ','
+    yield '[]' if separator == '[' else ']'
+
+def job_csv_rows(job: models.Job) -> Generator[Tuple, None, None]:
+    '''
+    Generate the CSV rows of a Job database object, one for each combination
+    of its listed values, in the order of CSV_FIELDS
+    '''
+    employer = job.employer
+    location = job.location
+    salary = job.salary
+    industries = employer.industries if employer is not None else None
+    for technology, industry, experience, role, job_type, joel_test, skill, remote in product(
+            job.technologies or [None], industries or [None], job.experience or [None],
+            job.roles or [None], job.job_types or [None], job.joel_test or [None],
+            job.skills or [None], job.remote or [None]):
+        yield (job.id, job.title, technology,
+               employer.name if employer is not None else None,
+               employer.size if employer is not None else None,
+               industry,
+               employer.company_type if employer is not None else None,
+               experience, role, job_type, joel_test, skill, job.created,
+               location.longitude if location is not None else None,
+               location.latitude if location is not None else None,
+               location.country_code if location is not None else None,
+               salary.minimum if salary is not None else None,
+               salary.maximum if salary is not None else None,
+               job.visa, job.equity, job.relocation, None, remote)
+
+def get_jobs_csv(jobs: Iterable[models.Job]) -> Generator[str, None, None]:
+    '''
+    Given Job database objects, generates comma separated values in chunks,
+    with a row for every combination of the listed values of each job
     '''
     f = io.StringIO()
-    fieldnames = ['id', 'title', 'technologies',
-                    'employer_name', 'employer_size',
-                    'employer_industries', 'employer_company_type',
-                    'experience', 'roles', 'job_types',
-                    'joel_test', 'skills', 'created',
-                    'location_longitude', 'location_latitude',
-                    'salary_minimum', 'salary_maximum',
-                    'visa', 'equity', 'relocation',
-                    'benefits', 'remote']
-    dw = DictWriter(f, fieldnames, extrasaction='ignore')
-    dw.writeheader()
-    yield f.getvalue()
+    writer = csv.writer(f)
+    writer.writerow(CSV_FIELDS)
     for job in jobs:
-        for row in unwind(flatten(schemas.Job.from_orm(job).dict())):
-            f = io.StringIO()
-            dw = DictWriter(f, fieldnames, extrasaction='ignore')
-            dw.writerow(row)
+        writer.writerows(job_csv_rows(job))
+        if f.tell() >= CSV_CHUNK_SIZE:
             yield f.getvalue()
+            f.seek(0)
+            f.truncate()
+    yield f.getvalue()
 
-def delete_job(db: Session, job: models.Job) -> None:
+def arrow_array(values: List[Any], type: pa.DataType) -> pa.Array:
+    '''
+    Build an arrow array of the given type, dictionary encoding the strings
+    '''
+    if pa.types.is_list(type):
+        # a null offset marks a null list
+        offsets = []
+        flat = []
+        for value in values:
+            offsets.append(len(flat) if value is not None else None)
+            flat.extend(value or [])
+        offsets.append(len(flat))
+        return pa.ListArray.from_arrays(
+            pa.array(offsets, pa.int32()), arrow_array(flat, type.value_type))
+    if pa.types.is_dictionary(type):
+        return pa.array(values, pa.string()).dictionary_encode()
+    return pa.array(values, type)
+
+def arrow_schema(fields: Optional[List[str]]=None) -> pa.Schema:
+    '''
+    Get the columns of ARROW_SCHEMA that belong to the given fields
     '''
-    Delete the job object from the database
+    if fields is None:
+        return ARROW_SCHEMA
+    return pa.schema([column for column in ARROW_SCHEMA
+                      if column.name.split('.')[0] in fields])
+
+def job_record_batch(jobs: List[models.Job], schema: pa.Schema=ARROW_SCHEMA) -> pa.RecordBatch:
+    '''
+    Build a record batch with the given columns of ARROW_SCHEMA from the
+    given Job database objects
+    '''
+    fields = list(dict.fromkeys(name.split('.')[0] for name in schema.names))
+    docs = [job_dict(job, fields) for job in jobs]
+    arrays = []
+    for column in schema:
+        field, _, key = column.name.partition('.')
+        if key:
+            values = [doc[field][key] if doc[field] is not None else None for doc in docs]
+        else:
+            values = [doc[field] for doc in docs]
+        arrays.append(arrow_array(values, column.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class ChunkSink(io.RawIOBase):
+    '''
+    A writable stream that keeps what is written until it is taken
+    '''
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def batches(jobs: Iterable[models.Job], size: int=STREAM_BATCH_SIZE) -> Generator[List[models.Job], None, None]:
+    '''
+    Group the given jobs in lists of at most size jobs
+    '''
+    batch = []
+    for job in jobs:
+        batch.append(job)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def get_jobs_arrow(jobs: Iterable[models.Job], fields: Optional[List[str]]=None) -> Generator[bytes, None, None]:
+    '''
+    Given Job database objects, generates an Arrow IPC stream of record batches
+    '''
+    schema = arrow_schema(fields)
+    sink = ChunkSink()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for batch in batches(jobs):
+            writer.write_batch(job_record_batch(batch, schema))
+            yield sink.take()
+    yield sink.take()
+
+def get_jobs_parquet(jobs: Iterable[models.Job], fields: Optional[List[str]]=None) -> Generator[bytes, None, None]:
+    '''
+    Given Job database objects, generates a Parquet file with a row group
+    for each batch of jobs
+    '''
+    schema = arrow_schema(fields)
+    sink = ChunkSink()
+    with pq.ParquetWriter(sink, schema, compression='zstd') as writer:
+        for batch in batches(jobs):
+            writer.write_table(pa.Table.from_batches([job_record_batch(batch, schema)]))
+            yield sink.take()
+    yield sink.take()
+
+def supports_copy(db: Session) -> bool:
+    '''
+    Check if the session can export with COPY through its database driver
+    '''
+    return db.get_bind().dialect.driver == 'psycopg2'
+
+def copy_jobs_csv(db: Session, offset: int=0, limit: Optional[int]=None,
+                  after_id: Optional[int]=None, updated_since: Optional[datetime]=None,
+                  created_since: Optional[datetime]=None,
+                  job_ids: Optional[List[int]]=None) -> Generator[bytes, None, None]:
+    '''
+    Generate the comma separated values of get_jobs_csv for the jobs of
+    get_jobs, built by PostgreSQL from the job_csv view with COPY and streamed
+    while they are produced. The rows are the same, with the creation times
+    written as str writes them, but the rows of a job are ordered by their
+    listed values rather than in the order the values are loaded
+    '''
+    jobs = filter_jobs(select(models.Job.id), after_id=after_id,
+                       updated_since=updated_since, created_since=created_since, job_ids=job_ids)
+    jobs = jobs.order_by(models.Job.id).offset(offset).limit(limit)
+    view = sql_table('job_csv', *[sql_column(field) for field in CSV_FIELDS])
+    # the microseconds are only written when there are any, as str does
+    created = func.concat(func.to_char(view.c.created, 'YYYY-MM-DD HH24:MI:SS'), case(
+        (func.to_char(view.c.created, 'US') != '000000',
+         func.to_char(view.c.created, '.US'))))
+    fields = [created.label(field) if field == 'created' else view.c[field] for field in CSV_FIELDS]
+    q = select(*fields).where(view.c.id.in_(jobs)).order_by(
+        view.c.id, *[view.c[field] for field in CSV_LISTED_FIELDS])
+    compiled = q.compile(dialect=db.get_bind().dialect, compile_kwargs={'render_postcompile': True})
+    connection = db.connection().connection
+    with connection.cursor() as cursor:
+        sql = 'COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)'.format(
+            cursor.mogrify(str(compiled), compiled.params).decode())
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def copy() -> None:
+        try:
+            with os.fdopen(write_fd, 'wb') as f, connection.cursor() as cursor:
+                cursor.copy_expert(sql, f)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=copy, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = os.read(read_fd, CSV_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        os.close(read_fd)
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def feature_pairs(feature: str) -> Any:
+    '''
+    Select the (job_id, value) pairs of the given feature, which is one of
+    STATS_FEATURES
+    '''
+    job = models.Job
+    if feature == 'country':
+        return select(job.id.label('job_id'), models.Location.country_code.label('value')).join(
+            models.Location, models.Location.id == job.location_id)
+    if feature == 'industries':
+        return select(job.id.label('job_id'), models.Industry.name.label('value')).join(
+            models.company_industry, models.company_industry.c.company_id == job.employer_id).join(
+            models.Industry, models.Industry.id == models.company_industry.c.industry_id)
+    model, table, column = JOB_DIMENSIONS[feature]
+    return select(job.id.label('job_id'), model.name.label('value')).join(
+        table, table.c.job_id == job.id).join(model, model.id == table.c[column])
+
+def filter_created(q: Any, start: Optional[date]=None, end: Optional[date]=None) -> Any:
+    '''
+    Restrict a select of jobs to those created from the start to the end date,
+    both inclusive
     '''
+    if start is not None:
+        q = q.where(models.Job.created >= start)
+    if end is not None:
+        q = q.where(models.Job.created < end + timedelta(days=1))
+    return q
+
+def count_values(db: Session, feature: str, top: Optional[int]=None,
+                 start: Optional[date]=None, end: Optional[date]=None) -> List[Dict[str, Any]]:
+    '''
+    Count the jobs created in the period for each value of the feature,
+    keeping the top most common values
+    '''
+    pairs = filter_created(feature_pairs(feature), start, end).subquery()
+    count = func.count().label('count')
+    q = select(pairs.c.value, count).group_by(pairs.c.value).order_by(count.desc(), pairs.c.value)
+    if top is not None:
+        q = q.limit(top)
+    return [dict(row._mapping) for row in db.execute(q)]
+
+def count_value_pairs(db: Session, feature: str, by: str, top: Optional[int]=None,
+                      start: Optional[date]=None, end: Optional[date]=None) -> List[Dict[str, Any]]:
+    '''
+    Count the jobs created in the period for each pair of values of the
+    feature and of the by feature, keeping the top most common values of
+    the feature
+    '''
+    pairs = filter_created(feature_pairs(feature), start, end).subquery()
+    others = feature_pairs(by).subquery()
+    count = func.count().label('count')
+    q = select(pairs.c.value, others.c.value.label('by'), count).join(
+        others, others.c.job_id == pairs.c.job_id
+    ).group_by(pairs.c.value, others.c.value).order_by(pairs.c.value, count.desc())
+    if top is not None:
+        top_values = select(pairs.c.value).group_by(pairs.c.value).order_by(
+            func.count().desc(), pairs.c.value).limit(top)
+        q = q.where(pairs.c.value.in_(top_values))
+    return [dict(row._mapping) for row in db.execute(q)]
+
+def count_visa_relocation(db: Session, start: Optional[date]=None,
+                          end: Optional[date]=None) -> List[Dict[str, Any]]:
+    '''
+    Count the jobs created in the period for each country and each
+    combination of visa and relocation help
+    '''
+    country = models.Location.country_code.label('country')
+    count = func.count().label('count')
+    q = select(country, models.Job.visa, models.Job.relocation, count).outerjoin(
+        models.Location, models.Location.id == models.Job.location_id
+    ).group_by(country, models.Job.visa, models.Job.relocation).order_by(country)
+    return [dict(row._mapping) for row in db.execute(filter_created(q, start, end))]
+
+def summarize_salaries(db: Session, feature: str, top: Optional[int]=None,
+                       start: Optional[date]=None, end: Optional[date]=None) -> List[Dict[str, Any]]:
+    '''
+    Summarize the salaries of the jobs created in the period for each value
+    of the feature, keeping the top most common values among jobs with a salary
+    '''
+    pairs = filter_created(feature_pairs(feature), start, end).subquery()
+    salary = models.Salary
+    count = func.count().label('count')
+    q = select(
+        pairs.c.value,
+        count,
+        func.min(salary.minimum).label('minimum'),
+        func.avg(salary.minimum).label('minimum_mean'),
+        func.percentile_cont(0.5).within_group(salary.minimum).label('minimum_median'),
+        func.avg(salary.maximum).label('maximum_mean'),
+        func.percentile_cont(0.5).within_group(salary.maximum).label('maximum_median'),
+        func.max(salary.maximum).label('maximum'),
+    ).select_from(pairs).join(
+        models.Job, models.Job.id == pairs.c.job_id
+    ).join(
+        salary, salary.id == models.Job.salary_id
+    ).group_by(pairs.c.value).order_by(count.desc(), pairs.c.value)
+    if top is not None:
+        q = q.limit(top)
+    return [dict(row._mapping) for row in db.execute(q)]
+
+def count_cooccurrences(db: Session, feature: str, top: Optional[int]=None,
+                        start: Optional[date]=None, end: Optional[date]=None) -> List[Dict[str, Any]]:
+    '''
+    Count the jobs created in the period for each pair of different values of
+    the feature, keeping the top most common pairs
+    '''
+    table = COOCCURRENCE_TABLES[feature]
+    model = JOB_DIMENSIONS[feature][0]
+    count = func.sum(table.c.count).label('count')
+    q = select(table.c.first_id, table.c.second_id, count).group_by(
+        table.c.first_id, table.c.second_id).order_by(count.desc())
+    if start is not None:
+        q = q.where(table.c.day >= start)
+    if end is not None:
+        q = q.where(table.c.day <= end)
+    if top is not None:
+        q = q.limit(top)
+    pairs = q.subquery()
+    first, second = aliased(model), aliased(model)
+    q = select(first.name.label('source'), second.name.label('target'), pairs.c.count).join(
+        first, first.id == pairs.c.first_id
+    ).join(
+        second, second.id == pairs.c.second_id
+    ).order_by(pairs.c.count.desc(), first.name, second.name)
+    return [dict(row._mapping) for row in db.execute(q)]
+
+def delete_job(db: Session, job: models.Job) -> None:
+    '''
+    Delete the job object from the database, keeping a record of the deletion
+    '''
+    if job.id not in lock_jobs(db=db, job_ids=[job.id]):
+        # deleted concurrently
+        return
+    update_cooccurrences(db=db, removed=stored_cooccurrences(db=db, job_ids=[job.id]))
+    db.info['jobs_changed'] = True
+    stmt = insert(models.JobTombstone.__table__).values(
+        id=job.id, url=job.url, deleted=datetime.utcnow())
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[models.JobTombstone.__table__.c.id],
+        set_={'url': stmt.excluded.url, 'deleted': stmt.excluded.deleted}))
     db.delete(job)
     db.commit()
+
+def get_archive_months(db: Session, before: datetime) -> List[datetime]:
+    '''
+    Get the first day of each month with jobs created before the given time
+    '''
+    month = func.date_trunc('month', models.Job.created)
+    q = select(month).where(models.Job.created < before).group_by(month).order_by(month)
+    return db.execute(q).scalars().all()
+
+def get_job_ids_created(db: Session, start: datetime, end: datetime) -> List[int]:
+    '''
+    Get the ids of the jobs created from start until before end
+    '''
+    q = select(models.Job.id).where(
+        models.Job.created >= start, models.Job.created < end).order_by(models.Job.id)
+    return db.execute(q).scalars().all()
+
+def purge_jobs(db: Session, job_ids: List[int]) -> None:
+    '''
+    Delete the given jobs with their association rows and value pairs,
+    without keeping records of the deletion, as when they are archived
+    '''
+    lock_jobs(db=db, job_ids=job_ids)
+    update_cooccurrences(db=db, removed=stored_cooccurrences(db=db, job_ids=job_ids))
+    for chunk in chunks(job_ids):
+        for _, table, _ in JOB_DIMENSIONS.values():
+            db.execute(table.delete().where(table.c.job_id.in_(chunk)))
+        db.execute(models.Job.__table__.delete().where(models.Job.id.in_(chunk)))
+    db.info['jobs_changed'] = True
+
+def purge_tombstones(db: Session, before: datetime) -> int:
+    '''
+    Delete the records of the jobs deleted before the given time.
+    Returns the number of records deleted
+    '''
+    table = models.JobTombstone.__table__
+    return db.execute(table.delete().where(table.c.deleted < before)).rowcount
@@ -1,16 +1,172 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+from bisect import bisect_left
+from typing import Any, Dict, Optional
 import os
+import threading
+import time
 # from dotenv import load_dotenv
 
 # BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # load_dotenv(os.path.join(BASE_DIR, ".env"))
 
+def env_int(name: str, default: Optional[int]) -> Optional[int]:
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+def env_bool(name: str, default: bool=False) -> bool:
+    value = os.environ.get(name)
+    return value.lower() in ("1", "true", "yes") if value else default
+
 DATABASE_URL = os.environ.get("DATABASE_URL")
 
-engine = create_engine(DATABASE_URL)
+# serve the requests with asyncio sessions on the asyncpg driver
+DATABASE_ASYNC = env_bool("DATABASE_ASYNC")
+
+# the connections kept open per process and the extra ones opened under load
+POOL_SIZE = env_int("DATABASE_POOL_SIZE", 5)
+MAX_OVERFLOW = env_int("DATABASE_MAX_OVERFLOW", 10)
+# the seconds to wait for a connection before failing the checkout
+POOL_TIMEOUT = env_int("DATABASE_POOL_TIMEOUT", 30)
+# the seconds after which a connection is replaced, -1 for never
+POOL_RECYCLE = env_int("DATABASE_POOL_RECYCLE", -1)
+# test each connection on checkout, to recover from restarts of the server
+POOL_PRE_PING = env_bool("DATABASE_POOL_PRE_PING")
+# the milliseconds after which the server cancels a statement
+STATEMENT_TIMEOUT = env_int("DATABASE_STATEMENT_TIMEOUT", None)
+# connect through PgBouncer in transaction pooling mode: PgBouncer pools the
+# connections, server settings are set per transaction and asyncpg does not
+# prepare statements
+PGBOUNCER = env_bool("DATABASE_PGBOUNCER")
+
+# the upper bounds of the buckets of the checkout wait histogram, in seconds
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float('inf'))
+
+
+class WaitStats:
+    '''
+    A histogram of the time spent waiting for a connection of a pool
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * len(WAIT_BUCKETS)
+        self.total = 0.0
+        self.maximum = 0.0
+        self.timeouts = 0
+
+    def observe(self, seconds: float, timeout: bool=False) -> None:
+        with self.lock:
+            self.counts[bisect_left(WAIT_BUCKETS, seconds)] += 1
+            self.total += seconds
+            self.maximum = max(self.maximum, seconds)
+            self.timeouts += timeout
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            checkouts = sum(self.counts)
+            return {'checkouts': checkouts,
+                    'timeouts': self.timeouts,
+                    'wait_mean': self.total / checkouts if checkouts else 0.0,
+                    'wait_max': self.maximum,
+                    'wait_histogram': {'le_{}'.format(bound): count
+                                       for bound, count in zip(WAIT_BUCKETS, self.counts)}}
+
+
+class TimedPool:
+    '''
+    Mixin of a queue pool that records how long each checkout waits for a
+    connection, including the time to open a new one
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = WaitStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except TimeoutError:
+            self.wait_stats.observe(time.perf_counter() - start, timeout=True)
+            raise
+        self.wait_stats.observe(time.perf_counter() - start)
+        return connection
+
+
+class TimedQueuePool(TimedPool, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(TimedPool, AsyncAdaptedQueuePool):
+    pass
+
+
+def engine_options(asyncio: bool=False) -> Dict[str, Any]:
+    '''
+    Get the keyword arguments of create_engine from the configuration
+    '''
+    if PGBOUNCER:
+        options = {'poolclass': NullPool}
+    else:
+        options = {'poolclass': TimedAsyncAdaptedQueuePool if asyncio else TimedQueuePool,
+                   'pool_size': POOL_SIZE,
+                   'max_overflow': MAX_OVERFLOW,
+                   'pool_timeout': POOL_TIMEOUT,
+                   'pool_recycle': POOL_RECYCLE}
+    options['pool_pre_ping'] = POOL_PRE_PING
+    if PGBOUNCER and asyncio:
+        options['connect_args'] = {'statement_cache_size': 0, 'prepared_statement_cache_size': 0}
+    elif STATEMENT_TIMEOUT is not None and not PGBOUNCER:
+        if asyncio:
+            options['connect_args'] = {'server_settings': {'statement_timeout': str(STATEMENT_TIMEOUT)}}
+        else:
+            options['connect_args'] = {'options': '-c statement_timeout={}'.format(STATEMENT_TIMEOUT)}
+    return options
+
+
+def set_transaction_timeout(connection) -> None:
+    '''
+    Set the statement timeout of a transaction, as PgBouncer does not pass
+    the settings of the connection to the server
+    '''
+    connection.exec_driver_sql('SET LOCAL statement_timeout = {:d}'.format(STATEMENT_TIMEOUT))
+
+
+def pool_stats(engine) -> Dict[str, Any]:
+    '''
+    Get the state of the pool of an engine and the waits of its checkouts
+    '''
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__, 'status': pool.status()}
+    if isinstance(pool, QueuePool):
+        stats.update({'size': pool.size(),
+                      'checked_in': pool.checkedin(),
+                      'checked_out': pool.checkedout(),
+                      'overflow': pool.overflow(),
+                      'max_overflow': pool._max_overflow,
+                      'timeout': pool.timeout()})
+    if isinstance(pool, TimedPool):
+        stats.update(pool.wait_stats.stats())
+    return stats
+
+
+engine = create_engine(DATABASE_URL, **engine_options())
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-Base = declarative_base()
\ No newline at end of file
+if DATABASE_ASYNC:
+    ASYNC_DATABASE_URL = os.environ.get("ASYNC_DATABASE_URL") or \
+        make_url(DATABASE_URL).set(drivername="postgresql+asyncpg")
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, **engine_options(asyncio=True))
+    AsyncSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=async_engine, class_=AsyncSession)
+
+if PGBOUNCER and STATEMENT_TIMEOUT is not None:
+    event.listen(engine, 'begin', set_transaction_timeout)
+    if DATABASE_ASYNC:
+        event.listen(async_engine.sync_engine, 'begin', set_transaction_timeout)
+
+Base = declarative_base()
@@ -1,109 +1,474 @@
 from typing import Optional, List
-from fastapi import FastAPI, Depends, HTTPException, Request, Response
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response
 from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy import ext
-from sqlalchemy.orm import Session
-import io
-from csv import DictWriter
+from async_crud import AnySession
 import uvicorn
-from datetime import timezone
+from datetime import date, datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+import hashlib
+import os
+from functools import partial
+from urllib.parse import urlencode
 
-import crud, models, schemas
-from database import SessionLocal, engine
+import async_crud, crud, models, schemas
+import database
+from bloom import existence_filter
+from cache import response_cache
+from database import DATABASE_ASYNC, SessionLocal, engine
+if DATABASE_ASYNC:
+    from database import AsyncSessionLocal, async_engine
 
 models.Base.metadata.create_all(bind=engine)
 
 app = FastAPI()
 
+# the number of jobs in a page of the collection when no limit is given
+PAGE_SIZE = 1000
+
 # Dependency
-def get_db():
+async def get_db():
+    if DATABASE_ASYNC:
+        async with AsyncSessionLocal() as db:
+            yield db
+    else:
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            await run_in_threadpool(db.close)
+
+
+def http_date(value: datetime) -> str:
+    """Format a naive UTC datetime as an HTTP date."""
+    return format_datetime(value.replace(tzinfo=timezone.utc, microsecond=0), usegmt=True)
+
+
+def check_modified(request: Request, response: Response, etag: str,
+                   last_modified: Optional[datetime]) -> Optional[Response]:
+    """
+    Set the validators of the response and evaluate the conditional headers of
+    the request against them. Returns a 304 response if the client already
+    has the current representation, otherwise None.
+    """
+    response.headers['ETag'] = etag
+    if last_modified is not None:
+        response.headers['Last-Modified'] = http_date(last_modified)
+    if_none_match = request.headers.get('If-None-Match')
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_none_match is not None:
+        # weak comparison, ignoring the W/ prefix
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        not_modified = '*' in tags or etag[2:] in tags
+    elif if_modified_since is not None and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return None
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        not_modified = last_modified.replace(microsecond=0) <= since
+    else:
+        not_modified = False
+    if not_modified:
+        return Response(status_code=304, headers=dict(response.headers))
+    return None
+
+
+def collection_etag(request: Request, version: tuple) -> str:
+    """Compute the entity tag of a representation of a collection."""
+    key = repr((request.url.path, sorted(request.query_params.multi_items()), tuple(version)))
+    return 'W/"{}"'.format(hashlib.sha1(key.encode()).hexdigest())
+
+
+def job_etag(job_id: int, updated: Optional[datetime]) -> str:
+    """Compute the entity tag of a job."""
+    return 'W/"{}-{}"'.format(job_id, updated.isoformat() if updated is not None else '')
+
+
+def cacheable(request: Request) -> bool:
+    """Whether the response to a request is kept in the response cache."""
+    path = request.url.path
+    return (request.method == 'GET'
+            and (path == '/jobs' or path.startswith('/jobs/') or path.startswith('/stats/'))
+            # the other formats are streamed
+            and request.query_params.get('format', 'json') == 'json')
+
+
+@app.middleware("http")
+async def cache_responses(request: Request, call_next):
+    """
+    Serve the read endpoints from the response cache, and keep their
+    successful responses in it until a job is written or deleted.
+    """
+    if response_cache is None or not cacheable(request):
+        return await call_next(request)
+    query = urlencode(sorted(request.query_params.multi_items()))
+    key, entry = await run_in_threadpool(response_cache.get, request.url.path, query)
+    if entry is not None:
+        status, headers, body = entry
+        if 'etag' in headers:
+            last_modified = headers.get('last-modified')
+            if last_modified is not None:
+                last_modified = parsedate_to_datetime(last_modified).replace(tzinfo=None)
+            validators = Response()
+            del validators.headers['content-length']
+            not_modified = check_modified(request, validators, headers['etag'], last_modified)
+            if not_modified is not None:
+                return not_modified
+        return Response(content=body, status_code=status, headers=headers)
+    response = await call_next(request)
+    if key is None or response.status_code != 200:
+        return response
+    body = b''.join([chunk async for chunk in response.body_iterator])
+    headers = dict(response.headers)
+    await run_in_threadpool(response_cache.set, key, (response.status_code, headers, body))
+    return Response(content=body, status_code=response.status_code, headers=headers)
+
+
+def load_existence_filter():
+    """Load the existence filter with the ids and urls of the stored jobs."""
     db = SessionLocal()
     try:
-        yield db
+        crud.load_existence_filter(db)
     finally:
         db.close()
 
 
+@app.on_event("startup")
+def warm_caches():
+    """
+    Load the ids of the dimension tables in the cache and load the
+    existence filter.
+    """
+    db = SessionLocal()
+    try:
+        crud.warm_dimension_cache(db)
+    finally:
+        db.close()
+    if existence_filter is not None:
+        existence_filter.start(load_existence_filter)
+
+
 @app.post("/jobs", response_model=schemas.Job)
-def create_job(job: schemas.Job, request: Request, db: Session = Depends(get_db)):
+async def create_job(job: schemas.Job, request: Request, db: AnySession = Depends(get_db)):
     """Create a job resource and save it to the database if it does not exist."""
-    db_job = crud.get_job(db, job_id=job.id)
-    if db_job:
-        raise HTTPException(status_code=303, detail="Job already exists", headers={'Location': request.url.path+'/'+str(db_job.id)})
-    return crud.create_or_update_job(db=db, job=job)
+    if await async_crud.get_job_version(db, job_id=job.id) is not None:
+        raise HTTPException(status_code=303, detail="Job already exists", headers={'Location': request.url.path+'/'+str(job.id)})
+    try:
+        return await async_crud.create_or_update_job(db=db, job=job)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@app.post("/jobs/bulk", response_model=List[schemas.JobStatus])
+async def create_jobs(jobs: List[schemas.Job], db: AnySession = Depends(get_db)):
+    """Create or update a batch of job resources in a single transaction."""
+    return await async_crud.create_or_update_jobs(db=db, jobs=jobs)
+
+
+@app.post("/jobs/lookup", response_model=List[schemas.JobVersion])
+async def lookup_jobs(lookup: schemas.JobLookup, db: AnySession = Depends(get_db)):
+    """
+    Get the id, url and update time of the jobs with the given ids or urls,
+    so that a client can find the jobs it has to send in a single request.
+    The jobs that do not exist are left out.
+    """
+    return await async_crud.lookup_jobs(db=db, job_ids=lookup.ids, urls=lookup.urls)
 
 
 @app.put("/jobs/{job_id}", response_model=schemas.Job)
-def update_job(job: schemas.Job, db: Session = Depends(get_db)):
+async def update_job(job: schemas.Job, db: AnySession = Depends(get_db)):
     """Update the job resource."""
-    return crud.create_or_update_job(db=db, job=job)
-
-
-def get_jobs_csv(jobs: List[models.Job]):
-    """Unwind the jobs collection and generate each line."""
-    f = io.StringIO()
-    fieldnames = ['id', 'title', 'technologies',
-                  'employer_name', 'employer_size',
-                  'employer_industries', 'employer_company_type',
-                  'experience', 'roles', 'job_types',
-                  'joel_test', 'skills', 'created',
-                  'location_longitude', 'location_latitude', 'location_country_code',
-                  'salary_minimum', 'salary_maximum',
-                  'visa', 'equity', 'relocation',
-                  'benefits', 'remote']
-    dw = DictWriter(f, fieldnames, extrasaction='ignore')
-    dw.writeheader()
-    yield f.getvalue()
-    for job in jobs:
-        for row in crud.unwind(crud.flatten(schemas.Job.from_orm(job).dict())):
-            f = io.StringIO()
-            dw = DictWriter(f, fieldnames, extrasaction='ignore')
-            dw.writerow(row)
-            yield f.getvalue()
+    try:
+        return await async_crud.create_or_update_job(db=db, job=job)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
 
 @app.get("/jobs", response_model=List[schemas.Job])
-def read_jobs(offset: int = 0, limit: Optional[int] = None, format: str = 'json', db: Session = Depends(get_db)):
-    """Get the jobs collection."""
+async def read_jobs(request: Request, response: Response,
+              offset: int = 0, limit: Optional[int] = None, cursor: Optional[str] = None,
+              updated_since: Optional[datetime] = None, created_since: Optional[datetime] = None,
+              ids: Optional[str] = None, fields: Optional[str] = None, exclude: Optional[str] = None,
+              format: str = 'json', db: AnySession = Depends(get_db)):
+    """
+    Get the jobs collection.
+
+    Pages are selected either with offset/limit or, when a cursor is given,
+    with keyset pagination on the job id. An empty cursor starts from the
+    first job, and the cursor of the next page is returned in the Link and
+    X-Next-Cursor headers of a json response.
+
+    updated_since and created_since only list the jobs updated or created at
+    or after the given time, so that clients can pull the changes since their
+    last watermark. Deleted jobs are listed at /jobs/deleted. ids is a comma
+    separated list of job ids, to read a batch of jobs in one request.
+
+    The fields and exclude parameters are comma separated lists of job fields
+    to return and to leave out. Only the relationships of the returned
+    fields are loaded, and the description is only read when it is returned.
+
+    The csv format has a row for every combination of the listed values of
+    each job. The ndjson and json-stream formats stream the jobs as newline
+    delimited JSON or as a JSON array, while they are read from the database.
+    The arrow (IPC stream) and parquet formats stream a columnar table in
+    record batches, with the nested fields flattened as by
+    pandas.json_normalize.
+    """
+    try:
+        after_id = crud.decode_cursor(cursor) if cursor is not None else None
+        selected = crud.parse_fields(fields, exclude)
+        job_ids = crud.parse_ids(ids) if ids is not None else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    query = dict(after_id=after_id, updated_since=updated_since, created_since=created_since, job_ids=job_ids)
+    version = await async_crud.get_jobs_version(db)
+    # the update times are given by the clients, so only the entity tag validates the list
+    not_modified = check_modified(request, response, collection_etag(request, version), None)
+    if not_modified is not None:
+        return not_modified
     if format == 'csv':
-        jobs = crud.get_jobs(db, offset=0)
         return StreamingResponse(
-            crud.get_jobs_csv(jobs), 
+            async_crud.stream_jobs_csv(db=db, offset=offset, limit=limit, **query),
             media_type='text/csv',
-            headers={'Content-Disposition':"attachment; filename=jobs.csv"})
-    else:
-        jobs = crud.get_jobs(db=db, offset=offset, limit=limit)
-        return jobs
+            headers={**response.headers, 'Content-Disposition':"attachment; filename=jobs.csv"})
+    elif format == 'ndjson':
+        return StreamingResponse(
+            async_crud.stream_jobs(db, partial(crud.get_jobs_ndjson, fields=selected),
+                                   offset=offset, limit=limit, fields=selected, **query),
+            media_type='application/x-ndjson',
+            headers=dict(response.headers))
+    elif format == 'json-stream':
+        return StreamingResponse(
+            async_crud.stream_jobs(db, partial(crud.get_jobs_json, fields=selected),
+                                   offset=offset, limit=limit, fields=selected, **query),
+            media_type='application/json',
+            headers=dict(response.headers))
+    elif format == 'arrow':
+        return StreamingResponse(
+            async_crud.stream_jobs(db, partial(crud.get_jobs_arrow, fields=selected),
+                                   offset=offset, limit=limit, fields=selected, **query),
+            media_type='application/vnd.apache.arrow.stream',
+            headers=dict(response.headers))
+    elif format == 'parquet':
+        return StreamingResponse(
+            async_crud.stream_jobs(db, partial(crud.get_jobs_parquet, fields=selected),
+                                   offset=offset, limit=limit, fields=selected, **query),
+            media_type='application/vnd.apache.parquet',
+            headers={**response.headers, 'Content-Disposition':"attachment; filename=jobs.parquet"})
+    if cursor is not None:
+        limit = limit if limit is not None else PAGE_SIZE
+    jobs, last_id = await async_crud.get_job_document_texts(db=db, offset=offset, limit=limit, fields=selected, **query)
+    if cursor is not None and len(jobs) == limit:
+        next_cursor = crud.encode_cursor(last_id)
+        next_url = request.url.include_query_params(cursor=next_cursor, limit=limit)
+        response.headers['Link'] = '<{}>; rel="next"'.format(next_url)
+        response.headers['X-Next-Cursor'] = next_cursor
+    # the stored documents are in the layout of schemas.Job, so they skip its validation
+    return Response(content='[' + ','.join(jobs) + ']', media_type='application/json',
+                    headers=dict(response.headers))
+
+
+@app.get("/jobs/deleted", response_model=List[schemas.JobTombstone])
+async def read_deleted_jobs(request: Request, response: Response,
+                      deleted_since: Optional[datetime] = None, db: AnySession = Depends(get_db)):
+    """Get the jobs deleted at or after the given time."""
+    version = await async_crud.get_jobs_version(db)
+    not_modified = check_modified(request, response, collection_etag(request, version[3:]), version[4])
+    if not_modified is not None:
+        return not_modified
+    return await async_crud.get_tombstones(db=db, deleted_since=deleted_since)
+
+
+@app.get("/jobs/search", response_model=List[schemas.SearchResult])
+async def search_jobs(q: str, request: Request, response: Response,
+                      limit: int = Query(crud.SEARCH_PAGE_SIZE, ge=1, le=crud.SEARCH_MAX_PAGE_SIZE),
+                      cursor: Optional[str] = None, recent: Optional[int] = Query(None, ge=1),
+                      db: AnySession = Depends(get_db)):
+    """
+    Search the titles and descriptions of the jobs.
+
+    The query is in web search syntax: words, "quoted phrases", or and -word.
+    The results are ordered by relevance, with the matching words of the
+    description highlighted in their headline, and the cursor of the next
+    page is returned in the Link and X-Next-Cursor headers. With recent, only
+    that number of the most recently created matches are ranked, which
+    bounds the time of queries of common words.
+    """
+    try:
+        after = crud.decode_search_cursor(cursor) if cursor is not None else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    results = await async_crud.search_jobs(db=db, q=q, limit=limit, after=after, recent=recent)
+    if results and len(results) == limit:
+        next_cursor = crud.encode_search_cursor(results[-1]['rank'], results[-1]['id'])
+        next_url = request.url.include_query_params(cursor=next_cursor, limit=limit)
+        response.headers['Link'] = '<{}>; rel="next"'.format(next_url)
+        response.headers['X-Next-Cursor'] = next_cursor
+    return results
 
 
 @app.get("/jobs/{job_id}", response_model=schemas.Job)
-def read_job(job_id: int, db: Session = Depends(get_db)):
+async def read_job(job_id: int, request: Request, response: Response, db: AnySession = Depends(get_db)):
     """Get the job by the given id."""
-    db_job = crud.get_job(db=db, job_id=job_id)
-    if db_job is None:
+    version = await async_crud.get_job_version(db=db, job_id=job_id)
+    if version is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    s_job = schemas.Job.from_orm(db_job)
-    return s_job.dict()
+    not_modified = check_modified(request, response, job_etag(*version), version[1])
+    if not_modified is not None:
+        return not_modified
+    job = await async_crud.get_job_document_text(db=db, job_id=job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return Response(content=job, media_type='application/json', headers=dict(response.headers))
 
 
 @app.head("/jobs/{job_id}")
-def head_job(job_id: int, response: Response, db: Session = Depends(get_db)):
+async def head_job(job_id: int, request: Request, response: Response, db: AnySession = Depends(get_db)):
     """Respond for a query about a job with the given id."""
-    db_job = crud.get_job(db=db, job_id=job_id)
-    if db_job is None:
+    version = await async_crud.get_job_version(db=db, job_id=job_id)
+    if version is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    last_modified = db_job.updated.replace(tzinfo=timezone.utc).strftime("%a, %d %b %Y %H:%M:%S %z")
-    headers = {'Last-Modified': last_modified}
-    return Response(headers=headers)
+    not_modified = check_modified(request, response, job_etag(*version), version[1])
+    if not_modified is not None:
+        return not_modified
+    return Response(headers=dict(response.headers))
 
 
 @app.delete("/jobs/{job_id}", status_code=204)
-def delete_job(job_id: int, db: Session = Depends(get_db)):
+async def delete_job(job_id: int, db: AnySession = Depends(get_db)):
     """Delete the job with the given id."""
-    db_job = crud.get_job(db=db, job_id=job_id)
-    if db_job is None:
+    if not await async_crud.delete_job(db=db, job_id=job_id):
         raise HTTPException(status_code=404, detail="Job not found")
-    crud.delete_job(db=db, job=db_job)
+
+
+def check_feature(feature: str) -> None:
+    """Ensure that the statistics can be aggregated on the given feature."""
+    if feature not in crud.STATS_FEATURES:
+        raise HTTPException(
+            status_code=400,
+            detail="Unknown feature, expected one of: {}".format(', '.join(crud.STATS_FEATURES)))
+
+
+async def check_stats_modified(request: Request, response: Response, db: AnySession) -> Optional[Response]:
+    """Evaluate the conditional headers of a request for statistics."""
+    version = await async_crud.get_jobs_version(db)
+    return check_modified(request, response, collection_etag(request, version), None)
+
+
+@app.get("/stats/counts", response_model=List[schemas.ValueCount])
+async def read_value_counts(feature: str, request: Request, response: Response,
+                      top: Optional[int] = Query(None, ge=1), start: Optional[date] = None,
+                      end: Optional[date] = None, db: AnySession = Depends(get_db)):
+    """Get the number of jobs created in the period for each value of the feature."""
+    check_feature(feature)
+    not_modified = await check_stats_modified(request, response, db)
+    if not_modified is not None:
+        return not_modified
+    return await async_crud.count_values(db=db, feature=feature, top=top, start=start, end=end)
+
+
+@app.get("/stats/crosstab", response_model=List[schemas.ValuePairCount])
+async def read_value_pair_counts(feature: str, by: str, request: Request, response: Response,
+                           top: Optional[int] = Query(None, ge=1), start: Optional[date] = None,
+                           end: Optional[date] = None, db: AnySession = Depends(get_db)):
+    """
+    Get the number of jobs created in the period for each pair of values of
+    the feature and the by feature, e.g. skills by country or joel_test by
+    remote. top keeps the most common values of the feature.
+    """
+    check_feature(feature)
+    check_feature(by)
+    not_modified = await check_stats_modified(request, response, db)
+    if not_modified is not None:
+        return not_modified
+    return await async_crud.count_value_pairs(db=db, feature=feature, by=by, top=top, start=start, end=end)
+
+
+@app.get("/stats/cooccurrence", response_model=List[schemas.CooccurrenceCount])
+async def read_cooccurrence_counts(feature: str, request: Request, response: Response,
+                             top: Optional[int] = Query(None, ge=1), start: Optional[date] = None,
+                             end: Optional[date] = None, db: AnySession = Depends(get_db)):
+    """Get the number of jobs created in the period for the top pairs of different values of the feature."""
+    if feature not in crud.COOCCURRENCE_TABLES:
+        raise HTTPException(
+            status_code=400,
+            detail="Unknown feature, expected one of: {}".format(', '.join(crud.COOCCURRENCE_TABLES)))
+    not_modified = await check_stats_modified(request, response, db)
+    if not_modified is not None:
+        return not_modified
+    return await async_crud.count_cooccurrences(db=db, feature=feature, top=top, start=start, end=end)
+
+
+@app.get("/stats/visa-relocation", response_model=List[schemas.VisaRelocationCount])
+async def read_visa_relocation_counts(request: Request, response: Response,
+                                start: Optional[date] = None, end: Optional[date] = None,
+                                db: AnySession = Depends(get_db)):
+    """Get the number of jobs created in the period per country, visa and relocation help."""
+    not_modified = await check_stats_modified(request, response, db)
+    if not_modified is not None:
+        return not_modified
+    return await async_crud.count_visa_relocation(db=db, start=start, end=end)
+
+
+@app.get("/stats/salary", response_model=List[schemas.SalarySummary])
+async def read_salary_summaries(feature: str, request: Request, response: Response,
+                          top: Optional[int] = Query(None, ge=1), start: Optional[date] = None,
+                          end: Optional[date] = None, db: AnySession = Depends(get_db)):
+    """Get a summary of the salaries of the jobs created in the period for each value of the feature."""
+    check_feature(feature)
+    not_modified = await check_stats_modified(request, response, db)
+    if not_modified is not None:
+        return not_modified
+    return await async_crud.summarize_salaries(db=db, feature=feature, top=top, start=start, end=end)
+
+
+@app.get("/diagnostics/dimension-cache")
+async def read_dimension_cache_stats():
+    """Get the size and the hit/miss counters of the dimension id cache."""
+    return crud.dimension_cache.stats()
+
+
+@app.get("/diagnostics/response-cache")
+async def read_response_cache_stats():
+    """Get the backend and the hit ratio and counters of the response cache of this worker process."""
+    if response_cache is None:
+        return {'backend': None}
+    return {'pid': os.getpid(), **response_cache.stats()}
+
+
+@app.get("/diagnostics/existence-filter")
+async def read_existence_filter_stats():
+    """
+    Get the size of the existence filter of this worker process, and the
+    counts of its answers, with its observed and estimated false positive rates.
+    """
+    if existence_filter is None:
+        return {'loaded': False}
+    return {'pid': os.getpid(), **existence_filter.stats()}
+
+
+@app.get("/diagnostics/pool")
+async def read_pool_stats():
+    """
+    Get the connection pool configuration and, for each engine of this worker
+    process, the connections in use and the checkout wait histogram.
+    """
+    engines = {'sync': database.pool_stats(engine)}
+    if DATABASE_ASYNC:
+        engines['async'] = database.pool_stats(async_engine.sync_engine)
+    return {'pid': os.getpid(),
+            'config': {'pool_size': database.POOL_SIZE,
+                       'max_overflow': database.MAX_OVERFLOW,
+                       'pool_timeout': database.POOL_TIMEOUT,
+                       'pool_recycle': database.POOL_RECYCLE,
+                       'pool_pre_ping': database.POOL_PRE_PING,
+                       'statement_timeout': database.STATEMENT_TIMEOUT,
+                       'pgbouncer': database.PGBOUNCER},
+            'engines': engines}
 
 
 if __name__ == '__main__':
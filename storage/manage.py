@@ -0,0 +1,166 @@
+'''
+Maintenance commands of the storage service:
+
+    python manage.py rebuild-documents [--all]
+    python manage.py archive [--months N] [--directory DIR] [--dry-run]
+    python manage.py restore FILE [FILE ...]
+'''
+import os
+import sys
+import gzip
+import argparse
+from collections import Counter
+from datetime import datetime
+from typing import List
+
+import orjson
+
+import crud, schemas
+from database import SessionLocal
+
+# the months of jobs kept in the database by archive, besides the current one
+RETENTION_MONTHS = int(os.environ.get('RETENTION_MONTHS', 12))
+# the directory of the archived jobs
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archive')
+
+
+def rebuild_documents(args: argparse.Namespace) -> None:
+    db = SessionLocal()
+    try:
+        count = crud.rebuild_documents(db, stale_only=not args.all)
+    finally:
+        db.close()
+    print('Rebuilt {} job documents'.format(count))
+
+
+def add_months(month: datetime, months: int) -> datetime:
+    '''
+    Get the first day of the month a number of months after the given one
+    '''
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def archive_path(directory: str, month: datetime) -> str:
+    '''
+    Get a new file name for the jobs of a month, numbering the files of the
+    jobs archived after the month was first archived
+    '''
+    name = 'jobs-{:%Y-%m}'.format(month)
+    path = os.path.join(directory, name + '.ndjson.gz')
+    number = 1
+    while os.path.exists(path):
+        number += 1
+        path = os.path.join(directory, '{}.{}.ndjson.gz'.format(name, number))
+    return path
+
+
+def archive_month(db, month: datetime, directory: str) -> int:
+    '''
+    Write the documents of the jobs created in a month to a gzipped NDJSON
+    file, then delete the jobs in a single transaction. The jobs are locked
+    before they are read, so that none is changed between the two.
+    Returns the number of jobs archived
+    '''
+    job_ids = crud.get_job_ids_created(db, start=month, end=add_months(month, 1))
+    job_ids = sorted(crud.lock_jobs(db, job_ids=job_ids))
+    if not job_ids:
+        return 0
+    path = archive_path(directory, month)
+    partial = path + '.partial'
+    with gzip.open(partial, 'wt', encoding='utf-8') as f:
+        for chunk in crud.chunks(job_ids):
+            texts, _ = crud.get_job_document_texts(db, job_ids=chunk)
+            f.writelines(text + '\n' for text in texts)
+    # the jobs are only deleted once their file is complete on disk
+    with open(partial, 'rb') as f:
+        os.fsync(f.fileno())
+    os.rename(partial, path)
+    crud.purge_jobs(db, job_ids=job_ids)
+    db.commit()
+    print('Archived {} jobs of {:%Y-%m} to {}'.format(len(job_ids), month, path))
+    return len(job_ids)
+
+
+def archive(args: argparse.Namespace) -> None:
+    before = add_months(datetime.utcnow(), -args.months)
+    os.makedirs(args.directory, exist_ok=True)
+    db = SessionLocal()
+    try:
+        months = crud.get_archive_months(db, before=before)
+        if args.dry_run:
+            for month in months:
+                count = len(crud.get_job_ids_created(db, start=month, end=add_months(month, 1)))
+                print('Would archive {} jobs of {:%Y-%m}'.format(count, month))
+            return
+        count = sum(archive_month(db, month, args.directory) for month in months)
+        tombstones = crud.purge_tombstones(db, before=before)
+        db.commit()
+    finally:
+        db.close()
+    print('Archived {} jobs created before {:%Y-%m-%d}, deleted {} deletion records'.format(
+        count, before, tombstones))
+
+
+def restore_jobs(db, jobs: List[schemas.Job], counts: Counter) -> None:
+    '''
+    Write a batch of archived jobs, counting their statuses and printing
+    the jobs that failed
+    '''
+    for status in crud.create_or_update_jobs(db, jobs=jobs):
+        counts[status.status] += 1
+        if status.status == 'failed':
+            print('Job {} failed: {}'.format(status.id, status.detail), file=sys.stderr)
+
+
+def restore(args: argparse.Namespace) -> None:
+    failed = 0
+    db = SessionLocal()
+    try:
+        for path in args.files:
+            counts = Counter()
+            with gzip.open(path, 'rb') as f:
+                jobs = []
+                for line in f:
+                    jobs.append(schemas.Job(**orjson.loads(line)))
+                    if len(jobs) == crud.BATCH_SIZE:
+                        restore_jobs(db, jobs, counts)
+                        jobs = []
+                if jobs:
+                    restore_jobs(db, jobs, counts)
+            print('Restored {} jobs from {}, {} unchanged, {} failed'.format(
+                counts['created'] + counts['updated'], path, counts['unchanged'], counts['failed']))
+            failed += counts['failed']
+    finally:
+        db.close()
+    if failed:
+        sys.exit('Failed to restore {} jobs'.format(failed))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Maintenance commands of the storage service')
+    commands = parser.add_subparsers(dest='command', required=True)
+    rebuild = commands.add_parser(
+        'rebuild-documents',
+        help='store the documents of the jobs whose document is missing or out of date')
+    rebuild.add_argument('--all', action='store_true', help='rebuild the documents of all the jobs')
+    rebuild.set_defaults(handler=rebuild_documents)
+    archiving = commands.add_parser(
+        'archive',
+        help='move the jobs of the months before the retention period to compressed files')
+    archiving.add_argument('--months', type=int, default=RETENTION_MONTHS,
+                           help='the months kept besides the current one (default: %(default)s)')
+    archiving.add_argument('--directory', default=ARCHIVE_DIR,
+                           help='the directory of the archives (default: %(default)s)')
+    archiving.add_argument('--dry-run', action='store_true',
+                           help='only print the number of jobs of each month to archive')
+    archiving.set_defaults(handler=archive)
+    restoring = commands.add_parser('restore', help='load the jobs of archives back into the database')
+    restoring.add_argument('files', nargs='+', help='the archives written by archive')
+    restoring.set_defaults(handler=restore)
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,56 +1,97 @@
 import sqlalchemy as sa
 import sqlalchemy.orm as orm
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
 from sqlalchemy.ext.associationproxy import association_proxy
 from database import Base
 
+# the text search configuration of the jobs
+SEARCH_CONFIG = 'english'
+
+# the words of the title, weighted above those of the description with its
+# html tags removed
+SEARCH_VECTOR = (
+    "setweight(to_tsvector('{0}', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('{0}', regexp_replace(coalesce(description, ''), '<[^>]*>', ' ', 'g')), 'B')"
+).format(SEARCH_CONFIG)
+
 class SurrogatePK:
     id = sa.Column(sa.Integer, primary_key=True)
 
 job_remote = sa.Table(
     'job_remote', Base.metadata,
-    sa.Column('job_id', sa.Integer, sa.ForeignKey('job.id')),
-    sa.Column('remote_id', sa.Integer, sa.ForeignKey('remote.id')))
+    sa.Column('job_id', sa.Integer, sa.ForeignKey('job.id'), primary_key=True),
+    sa.Column('remote_id', sa.Integer, sa.ForeignKey('remote.id'), primary_key=True, index=True))
 
 
 job_experience = sa.Table(
     'job_experience', Base.metadata,
-    sa.Column('job_id', sa.Integer, sa.ForeignKey('job.id')),
-    sa.Column('experience_id', sa.Integer, sa.ForeignKey('experience.id')))
+    sa.Column('job_id', sa.Integer, sa.ForeignKey('job.id'), primary_key=True),
+    sa.Column('experience_id', sa.Integer, sa.ForeignKey('experience.id'), primary_key=True, index=True))
 
 job_job_type = sa.Table(
     'job_job_type', Base.metadata,
-    sa.Column('job_id', sa.Integer, sa.ForeignKey('job.id')),
-    sa.Column('job_type_id', sa.Integer, sa.ForeignKey('job_type.id')))
+    sa.Column('job_id', sa.Integer, sa.ForeignKey('job.id'), primary_key=True),
+    sa.Column('job_type_id', sa.Integer, sa.ForeignKey('job_type.id'), primary_key=True, index=True))
 
 job_role = sa.Table(
     'job_role', Base.metadata,
-    sa.Column('job_id', sa.Integer, sa.ForeignKey('job.id')),
-    sa.Column('role_id', sa.Integer, sa.ForeignKey('role.id')))
+    sa.Column('job_id', sa.Integer, sa.ForeignKey('job.id'), primary_key=True),
+    sa.Column('role_id', sa.Integer, sa.ForeignKey('role.id'), primary_key=True, index=True))
 
 job_technology = sa.Table(
     'job_technology', Base.metadata,
-    sa.Column('job_id', sa.Integer, sa.ForeignKey('job.id')),
-    sa.Column('technology_id', sa.Integer, sa.ForeignKey('technology.id')))
+    sa.Column('job_id', sa.Integer, sa.ForeignKey('job.id'), primary_key=True),
+    sa.Column('technology_id', sa.Integer, sa.ForeignKey('technology.id'), primary_key=True, index=True))
 
 job_skill = sa.Table(
     'job_skill', Base.metadata,
-    sa.Column('job_id', sa.Integer, sa.ForeignKey('job.id')),
-    sa.Column('skill_id', sa.Integer, sa.ForeignKey('skill.id')))
+    sa.Column('job_id', sa.Integer, sa.ForeignKey('job.id'), primary_key=True),
+    sa.Column('skill_id', sa.Integer, sa.ForeignKey('skill.id'), primary_key=True, index=True))
 
 job_joel_test = sa.Table(
     'job_joel_test', Base.metadata,
-    sa.Column('job_id', sa.Integer, sa.ForeignKey('job.id')),
-    sa.Column('joel_test_id', sa.Integer, sa.ForeignKey('joel_test.id')))
+    sa.Column('job_id', sa.Integer, sa.ForeignKey('job.id'), primary_key=True),
+    sa.Column('joel_test_id', sa.Integer, sa.ForeignKey('joel_test.id'), primary_key=True, index=True))
 
 company_industry = sa.Table(
     'company_industry', Base.metadata,
-    sa.Column('company_id', sa.Integer, sa.ForeignKey('company.id')),
-    sa.Column('industry_id', sa.Integer, sa.ForeignKey('industry.id')))
+    sa.Column('company_id', sa.Integer, sa.ForeignKey('company.id'), primary_key=True),
+    sa.Column('industry_id', sa.Integer, sa.ForeignKey('industry.id'), primary_key=True, index=True))
 
 company_benefit = sa.Table(
     'company_benefit', Base.metadata,
-    sa.Column('company_id', sa.Integer, sa.ForeignKey('company.id')),
-    sa.Column('benefit_id', sa.Integer, sa.ForeignKey('benefit.id')))
+    sa.Column('company_id', sa.Integer, sa.ForeignKey('company.id'), primary_key=True),
+    sa.Column('benefit_id', sa.Integer, sa.ForeignKey('benefit.id'), primary_key=True, index=True))
+
+# the version of the jobs, a single row counting the commits that changed
+# them, which keys the cached responses
+job_version = sa.Table(
+    'job_version', Base.metadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('version', sa.BigInteger, nullable=False))
+
+# the number of jobs created each day that share a pair of values, with the
+# first id lower than the second one
+technology_cooccurrence = sa.Table(
+    'technology_cooccurrence', Base.metadata,
+    sa.Column('day', sa.Date, primary_key=True),
+    sa.Column('first_id', sa.Integer, sa.ForeignKey('technology.id'), primary_key=True),
+    sa.Column('second_id', sa.Integer, sa.ForeignKey('technology.id'), primary_key=True),
+    sa.Column('count', sa.Integer, nullable=False))
+
+role_cooccurrence = sa.Table(
+    'role_cooccurrence', Base.metadata,
+    sa.Column('day', sa.Date, primary_key=True),
+    sa.Column('first_id', sa.Integer, sa.ForeignKey('role.id'), primary_key=True),
+    sa.Column('second_id', sa.Integer, sa.ForeignKey('role.id'), primary_key=True),
+    sa.Column('count', sa.Integer, nullable=False))
+
+skill_cooccurrence = sa.Table(
+    'skill_cooccurrence', Base.metadata,
+    sa.Column('day', sa.Date, primary_key=True),
+    sa.Column('first_id', sa.Integer, sa.ForeignKey('skill.id'), primary_key=True),
+    sa.Column('second_id', sa.Integer, sa.ForeignKey('skill.id'), primary_key=True),
+    sa.Column('count', sa.Integer, nullable=False))
 
 
 class Job(Base, SurrogatePK):
@@ -94,9 +135,26 @@ class Job(Base, SurrogatePK):
     # joel_test = orm.relationship('JoelTest',
     #                              secondary=job_joel_test,
     #                              back_populates='jobs')
-    description = sa.Column(sa.String)
-    created = sa.Column(sa.DateTime)
-    updated = sa.Column(sa.DateTime)
+    # only loaded when it is asked for, see crud.job_load_options
+    description = orm.deferred(sa.Column(sa.String))
+    created = sa.Column(sa.DateTime, index=True)
+    updated = sa.Column(sa.DateTime, index=True)
+    # the serialized job, in the layout of schemas.Job, and the update time of
+    # the job it was built from
+    document = orm.deferred(sa.Column(JSONB))
+    document_updated = orm.deferred(sa.Column(sa.DateTime))
+    # computed by the database whenever the title or the description change
+    search_vector = orm.deferred(sa.Column(TSVECTOR, sa.Computed(SEARCH_VECTOR, persisted=True)))
+
+    __table_args__ = (
+        sa.Index('ix_job_search_vector', 'search_vector', postgresql_using='gin'),
+    )
+
+
+class JobTombstone(Base, SurrogatePK):
+    __tablename__ = 'job_tombstone'
+    url = sa.Column(sa.String)
+    deleted = sa.Column(sa.DateTime, index=True)
     
 
 class Company(Base, SurrogatePK):
@@ -194,3 +252,77 @@ class Benefit(Base, SurrogatePK):
     companies = orm.relationship('Company', 
                                  secondary=company_benefit,
                                  backref='company_benefits')
+
+# A view with a row for every combination of the listed values of a job,
+# which is the layout of the CSV export of the jobs collection
+job_csv = sa.DDL('''
+CREATE OR REPLACE VIEW job_csv AS
+SELECT job.id,
+       job.title,
+       technology.name AS technologies,
+       company.name AS employer_name,
+       company.size AS employer_size,
+       industry.name AS employer_industries,
+       company.company_type AS employer_company_type,
+       experience.name AS experience,
+       role.name AS roles,
+       job_type.name AS job_types,
+       joel_test.name AS joel_test,
+       skill.name AS skills,
+       job.created,
+       location.longitude AS location_longitude,
+       location.latitude AS location_latitude,
+       location.country_code AS location_country_code,
+       salary.minimum AS salary_minimum,
+       salary.maximum AS salary_maximum,
+       CASE WHEN job.visa THEN 'True' WHEN NOT job.visa THEN 'False' END AS visa,
+       CASE WHEN job.equity THEN 'True' WHEN NOT job.equity THEN 'False' END AS equity,
+       CASE WHEN job.relocation THEN 'True' WHEN NOT job.relocation THEN 'False' END AS relocation,
+       NULL::varchar AS benefits,
+       remote.name AS remote
+FROM job
+LEFT JOIN company ON company.id = job.employer_id
+LEFT JOIN location ON location.id = job.location_id
+LEFT JOIN salary ON salary.id = job.salary_id
+LEFT JOIN (company_industry JOIN industry ON industry.id = company_industry.industry_id)
+    ON company_industry.company_id = company.id
+LEFT JOIN (job_technology JOIN technology ON technology.id = job_technology.technology_id)
+    ON job_technology.job_id = job.id
+LEFT JOIN (job_experience JOIN experience ON experience.id = job_experience.experience_id)
+    ON job_experience.job_id = job.id
+LEFT JOIN (job_role JOIN role ON role.id = job_role.role_id)
+    ON job_role.job_id = job.id
+LEFT JOIN (job_job_type JOIN job_type ON job_type.id = job_job_type.job_type_id)
+    ON job_job_type.job_id = job.id
+LEFT JOIN (job_joel_test JOIN joel_test ON joel_test.id = job_joel_test.joel_test_id)
+    ON job_joel_test.job_id = job.id
+LEFT JOIN (job_skill JOIN skill ON skill.id = job_skill.skill_id)
+    ON job_skill.job_id = job.id
+LEFT JOIN (job_remote JOIN remote ON remote.id = job_remote.remote_id)
+    ON job_remote.job_id = job.id
+''')
+sa.event.listen(Base.metadata, 'after_create', job_csv)
+sa.event.listen(Base.metadata, 'before_drop', sa.DDL('DROP VIEW IF EXISTS job_csv'))
+
+
+def tune_job_storage(target, connection, **kw) -> None:
+    '''
+    Move the descriptions and the documents of the jobs out of their rows
+    once a row is over 256 bytes, so that the queries that skip them read
+    narrow rows, and compress them with lz4 where the server supports it
+    '''
+    connection.execute(sa.text('ALTER TABLE job SET (toast_tuple_target = 256)'))
+    if connection.dialect.server_version_info < (14,):
+        return
+    try:
+        with connection.begin_nested():
+            connection.execute(sa.text(
+                'ALTER TABLE job ALTER COLUMN description SET COMPRESSION lz4, '
+                'ALTER COLUMN document SET COMPRESSION lz4'))
+    except sa.exc.NotSupportedError:
+        pass
+
+sa.event.listen(Job.__table__, 'after_create', tune_job_storage)
+
+# create the backref attributes now, so that they can be used in queries
+orm.configure_mappers()
@@ -140,5 +140,66 @@ class Remote(BaseModel):
     class Config:
         orm_mode=True
 
+class JobTombstone(BaseModel):
+    id: int
+    url: Optional[str]
+    deleted: datetime
+
+    class Config:
+        orm_mode=True
+
+class JobStatus(BaseModel):
+    id: int
+    status: str
+    detail: Optional[str]
+
+class JobLookup(BaseModel):
+    ids: List[int] = []
+    urls: List[str] = []
+
+class JobVersion(BaseModel):
+    id: int
+    url: str
+    updated: datetime
+
+class SearchResult(BaseModel):
+    id: int
+    url: str
+    title: str
+    rank: float
+    headline: Optional[str]
+    created: datetime
+    updated: datetime
+
+class ValueCount(BaseModel):
+    value: Optional[str]
+    count: int
+
+class ValuePairCount(BaseModel):
+    value: Optional[str]
+    by: Optional[str]
+    count: int
+
+class CooccurrenceCount(BaseModel):
+    source: str
+    target: str
+    count: int
+
+class VisaRelocationCount(BaseModel):
+    country: Optional[str]
+    visa: Optional[bool]
+    relocation: Optional[bool]
+    count: int
+
+class SalarySummary(BaseModel):
+    value: Optional[str]
+    count: int
+    minimum: Optional[int]
+    minimum_mean: Optional[float]
+    minimum_median: Optional[float]
+    maximum_mean: Optional[float]
+    maximum_median: Optional[float]
+    maximum: Optional[int]
+
 Job.update_forward_refs()
 Company.update_forward_refs()
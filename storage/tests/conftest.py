@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+# the modules of the service import each other from the storage directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# the tests write to a database of their own, never to DATABASE_URL
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+if TEST_DATABASE_URL:
+    os.environ['DATABASE_URL'] = TEST_DATABASE_URL
+    os.environ.setdefault('RESPONSE_CACHE', 'false')
+
+
+@pytest.fixture
+def db():
+    if not TEST_DATABASE_URL:
+        pytest.skip('TEST_DATABASE_URL is not set')
+    import models
+    from database import SessionLocal, engine
+    models.Base.metadata.create_all(bind=engine)
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
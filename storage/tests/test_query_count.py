@@ -0,0 +1,58 @@
+from datetime import datetime
+
+from sqlalchemy import event
+
+
+def make_job(i):
+    import schemas
+    return schemas.Job(
+        id=1000000 + i, url='http://test/jobs/{}'.format(i), title='Job {}'.format(i),
+        employer={'name': 'Company {}'.format(i % 7), 'url': 'http://test/{}'.format(i % 7),
+                  'industries': ['Software', 'Industry {}'.format(i % 3)],
+                  'size': '10-50', 'company_type': 'Private', 'benefits': ['Benefit {}'.format(i % 2)]},
+        location={'latitude': 37.9 + i % 5, 'longitude': 23.7, 'country_code': 'gr'},
+        remote=['Remote'], equity=False, salary={'minimum': 1000 * (i % 4), 'maximum': 5000},
+        visa=bool(i % 2), relocation=False, experience=['Senior'], job_types=['Full-time'],
+        roles=['Backend Developer', 'Role {}'.format(i % 4)],
+        technologies=['python', 'technology {}'.format(i % 10)],
+        skills=['skill {}'.format(i % 6)], joel_test=['Source control'],
+        description='<p>Job {}</p>'.format(i),
+        created=datetime(2021, 6, 1 + i % 28), updated=datetime(2021, 7, 1))
+
+
+def count_queries(db, job_ids):
+    '''
+    Count the statements sent to read the given jobs and serialize all
+    their fields
+    '''
+    import crud
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = db.get_bind()
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        jobs = crud.get_jobs(db, job_ids=job_ids)
+        docs = [crud.job_dict(job, crud.JOB_FIELDS) for job in jobs]
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    db.rollback()
+    assert len(docs) == len(job_ids)
+    return len(statements)
+
+
+def test_get_jobs_query_count_is_constant(db):
+    import crud
+    jobs = [make_job(i) for i in range(200)]
+    job_ids = [job.id for job in jobs]
+    try:
+        statuses = crud.create_or_update_jobs(db, jobs=jobs)
+        assert {status.status for status in statuses} <= {'created', 'updated', 'unchanged'}
+        few = count_queries(db, job_ids[:10])
+        many = count_queries(db, job_ids)
+        assert few == many
+    finally:
+        crud.purge_jobs(db, job_ids=job_ids)
+        db.commit()